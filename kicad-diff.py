@@ -20,7 +20,8 @@ The default resolution for the images is 150 DPI. It can be increased for
 better images, at the cost of (exponentially) longer execution times. You can
 provide a smaller resolution for faster processing. For high resolution you
 could need to configure the ImageMagick limits. Consult the 'identify -list
-resource' command.
+resource' command. The --band_height option computes the diffs using bounded
+memory.
 For the SCHs we use KiAuto.
 
 """
@@ -34,25 +35,54 @@ __status__ = 'beta'
 __url__ = 'https://github.com/INTI-CMNB/KiDiff/'
 
 import argparse
+import array
 import atexit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import csv
+import fcntl
 from glob import glob
 from hashlib import sha1
+from importlib.util import find_spec
+from multiprocessing import get_context
+from multiprocessing.connection import wait as wait_connections
 import json
 import logging
 from os.path import isfile, isdir, basename, sep, splitext, abspath, dirname, getmtime
-from os import makedirs, rename, remove
-from pcbnew import (LoadBoard, PLOT_CONTROLLER, FromMM, PLOT_FORMAT_PDF, PLOT_FORMAT_SVG, Edge_Cuts, GetBuildVersion, ToMM,
-                    ZONE_FILLER, IsCopperLayer)
-import pcbnew
+from os import makedirs, rename, remove, cpu_count, listdir, walk, replace, getpid, stat, fstat
+from os import chdir, chmod, close, dup2, environ, fork, getuid, kill, pathsep, waitpid, _exit
+from os import WIFSIGNALED, WTERMSIG, WEXITSTATUS
+from os.path import getsize, join, relpath, realpath, exists, expanduser
 import re
 import shlex
+import signal
+import socket
+import sqlite3
 from shutil import rmtree, which, copy2
-from struct import unpack
+from struct import calcsize, pack, unpack
 from subprocess import call, PIPE, run, STDOUT, CalledProcessError, Popen, DEVNULL
-from sys import exit
-from tempfile import mkdtemp, NamedTemporaryFile
+from sys import exit, stdout, stderr
+from tempfile import mkdtemp, NamedTemporaryFile, gettempdir
+from threading import get_ident, Condition, Lock, Thread
 import time
+import zlib
+try:
+    import numpy as np
+    from PIL import Image, ImageColor, ImageDraw, ImageFont
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+try:
+    import pypdfium2 as pdfium
+    has_pdfium = True
+except ImportError:
+    has_pdfium = False
+try:
+    import cairosvg
+    has_cairosvg = True
+except (ImportError, OSError):
+    # OSError: no Cairo library
+    has_cairosvg = False
 
 # Exit error codes
 # Debugging
@@ -75,43 +105,74 @@ NOTHING_TO_COMPARE = 13
 kicad_version_major = kicad_version_minor = kicad_version_patch = 0
 cur_pcb_ops = cur_sch_ops = None
 is_pcb = True
-use_poppler = True
+# Tool used to convert the PDFs to bitmaps (see PDF2PNG and PDF2ARRAY)
+RASTERIZER = 'pdftoppm'
+# Join all the layers in one PDF and convert it using only one pdftoppm run
+use_single_pdf = False
 # Tools/Compatibility
 CONVERT = 'convert'
 FONT = ''
+# File containing the glyphs for FONT (used by the NumPy engine)
+FONT_FILE = None
+# Compute the diffs in-process using NumPy
+use_numpy = False
+# RGB values for --removed_2color and --added_2color, used by the NumPy engine (see parse_2color)
+removed_rgb = added_rgb = None
 # Compress SVG files using scour (KiRi mode)
 use_scour = False
-DEFAULT_LAYER_NAMES = {
-    pcbnew.F_Cu: 'F.Cu',
-    pcbnew.B_Cu: 'B.Cu',
-    pcbnew.F_Adhes: 'F.Adhes',
-    pcbnew.B_Adhes: 'B.Adhes',
-    pcbnew.F_Paste: 'F.Paste',
-    pcbnew.B_Paste: 'B.Paste',
-    pcbnew.F_SilkS: 'F.SilkS',
-    pcbnew.B_SilkS: 'B.SilkS',
-    pcbnew.F_Mask: 'F.Mask',
-    pcbnew.B_Mask: 'B.Mask',
-    pcbnew.Dwgs_User: 'Dwgs.User',
-    pcbnew.Cmts_User: 'Cmts.User',
-    pcbnew.Eco1_User: 'Eco1.User',
-    pcbnew.Eco2_User: 'Eco2.User',
-    pcbnew.Edge_Cuts: 'Edge.Cuts',
-    pcbnew.Margin: 'Margin',
-    pcbnew.F_CrtYd: 'F.CrtYd',
-    pcbnew.B_CrtYd: 'B.CrtYd',
-    pcbnew.F_Fab: 'F.Fab',
-    pcbnew.B_Fab: 'B.Fab',
-}
+# Background conversion of the plotted layers to PNG (see queue_pdf2png)
+raster_pool = None
+raster_jobs = {}
+# PDFium isn't thread-safe, only one thread can use it at a time (see pdf2array_pdfium)
+pdfium_lock = Lock()
+# PCBs already loaded, indexed by file name
+loaded_boards = {}
+# Running in a worker process (see GenImagesWorker)
+in_worker = False
+# Used by the workers to send the plotted layers to the parent process
+plot_notify = None
+# Area of the PCB pages converted to bitmaps (x, y, width, height in pixels), None is all (see --crop)
+crop_window = None
+# Margin around the PCB, in mm, for the cropped area
+CROP_MARGIN = 5
+# Locked cache entries, indexed by hash dir: the lock file and if the lock is exclusive (see LockCacheEntry)
+cache_locks = {}
+# Only one thread can change the mode of the locks (see WriteLockCacheEntry)
+cache_locks_lock = Lock()
+# Index for the cache metadata, stored in the cache dir
+CACHE_DB = 'kidiff-cache.db'
+# Connections to the index, one for each process, thread and cache dir
+cache_dbs = {}
+# Default Unix socket for the daemon mode (see --daemon), in a private directory
+DAEMON_SOCKET = (join(environ['XDG_RUNTIME_DIR'], 'kidiff-{}.sock'.format(getuid())) if environ.get('XDG_RUNTIME_DIR') else
+                 join(gettempdir(), 'kidiff-{}'.format(getuid()), 'daemon.sock'))
+# Tools detected by a previous run (see check_tools)
+TOOLS_CACHE = join(environ.get('XDG_CACHE_HOME') or join(expanduser('~'), '.cache'), 'kidiff', 'tools.json')
+# Tools we look for in the PATH
+PROBED_TOOLS = ('magick', 'convert', 'identify', 'pdftoppm', 'gs', 'pdfunite', 'scour', 'xdg-open', 'eeschema_do',
+                'rsvg-convert', 'kicad-cli')
+# Paths to the tools, None for the missing ones (see find_tool)
+tools = {}
+# Fields for each diff in the --batch manifest
+BATCH_FIELDS = ('old_file', 'new_file', 'old_file_hash', 'new_file_hash', 'name')
+# Buffer size used to compute the SHA1 of the files
+DIGEST_BUFFER = 1024*1024
+# Rows of the page processed at once when looking for the palette colors (see np_palette)
+PALETTE_BAND = 256
+# Layers with the same content in both PCBs, not plotted (see --skip_unchanged)
+unchanged_layers = set()
+# Tokens of the S-Expressions
+SEXP_TOKENS = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+# PCB items without layers that doesn't affect the plots
+SEXP_NOT_PLOTTED = {'group', 'generator', 'generator_version', 'version'}
+# Data that changes when saving the file, but doesn't affect the plots (see --normalized_hash)
+SEXP_VOLATILE = {'uuid', 'tstamp', 'tedit', 'generator', 'generator_version', 'group'}
+# KiCad PCB module, loaded only for PCBs (see load_pcbnew)
+pcbnew = None
+# Names for the layers, filled by load_pcbnew
+DEFAULT_LAYER_NAMES = {}
 SCHEMATIC_SVG_BASE_NAME = 'Schematic_root'
-if hasattr(pcbnew, 'DRILL_MARKS_NO_DRILL_SHAPE'):
-    NO_DRILL_SHAPE = pcbnew.DRILL_MARKS_NO_DRILL_SHAPE
-    SMALL_DRILL_SHAPE = pcbnew.DRILL_MARKS_SMALL_DRILL_SHAPE
-    FULL_DRILL_SHAPE = pcbnew.DRILL_MARKS_FULL_DRILL_SHAPE
-elif hasattr(pcbnew, 'PCB_PLOT_PARAMS'):
-    NO_DRILL_SHAPE = pcbnew.PCB_PLOT_PARAMS.NO_DRILL_SHAPE
-    SMALL_DRILL_SHAPE = pcbnew.PCB_PLOT_PARAMS.SMALL_DRILL_SHAPE
-    FULL_DRILL_SHAPE = pcbnew.PCB_PLOT_PARAMS.FULL_DRILL_SHAPE
+NO_DRILL_SHAPE = SMALL_DRILL_SHAPE = FULL_DRILL_SHAPE = None
 LA_KI8_2_KI9 = {0: 0, 1: 4, 2: 6, 3: 8, 4: 10, 5: 12, 6: 14, 7: 16, 8: 18, 9: 20, 10: 22, 11: 24, 12: 26, 13: 28, 14: 30,
                 15: 32, 16: 34, 17: 36, 18: 38, 19: 40, 20: 42, 21: 44, 22: 46, 23: 48, 24: 50, 25: 52, 26: 54, 27: 56,
                 28: 58, 29: 60, 30: 62, 31: 2, 32: 11, 33: 9, 34: 15, 35: 13, 36: 7, 37: 5, 38: 3, 39: 1, 40: 17, 41: 19,
@@ -119,6 +180,49 @@ LA_KI8_2_KI9 = {0: 0, 1: 4, 2: 6, 3: 8, 4: 10, 5: 12, 6: 14, 7: 16, 8: 18, 9: 20
                 55: 49, 56: 51, 57: 53, 58: 55, 59: 37}
 
 
+def load_pcbnew():
+    """ Import the KiCad PCB module, is slow and only needed for PCBs (SCHs are plotted using KiAuto) """
+    global pcbnew
+    global NO_DRILL_SHAPE
+    global SMALL_DRILL_SHAPE
+    global FULL_DRILL_SHAPE
+    if pcbnew is not None:
+        return
+    t = time.time()
+    import pcbnew
+    logger.debug('KiCad module loaded in {:.3f} s'.format(time.time()-t))
+    DEFAULT_LAYER_NAMES.update({
+        pcbnew.F_Cu: 'F.Cu',
+        pcbnew.B_Cu: 'B.Cu',
+        pcbnew.F_Adhes: 'F.Adhes',
+        pcbnew.B_Adhes: 'B.Adhes',
+        pcbnew.F_Paste: 'F.Paste',
+        pcbnew.B_Paste: 'B.Paste',
+        pcbnew.F_SilkS: 'F.SilkS',
+        pcbnew.B_SilkS: 'B.SilkS',
+        pcbnew.F_Mask: 'F.Mask',
+        pcbnew.B_Mask: 'B.Mask',
+        pcbnew.Dwgs_User: 'Dwgs.User',
+        pcbnew.Cmts_User: 'Cmts.User',
+        pcbnew.Eco1_User: 'Eco1.User',
+        pcbnew.Eco2_User: 'Eco2.User',
+        pcbnew.Edge_Cuts: 'Edge.Cuts',
+        pcbnew.Margin: 'Margin',
+        pcbnew.F_CrtYd: 'F.CrtYd',
+        pcbnew.B_CrtYd: 'B.CrtYd',
+        pcbnew.F_Fab: 'F.Fab',
+        pcbnew.B_Fab: 'B.Fab',
+    })
+    if hasattr(pcbnew, 'DRILL_MARKS_NO_DRILL_SHAPE'):
+        NO_DRILL_SHAPE = pcbnew.DRILL_MARKS_NO_DRILL_SHAPE
+        SMALL_DRILL_SHAPE = pcbnew.DRILL_MARKS_SMALL_DRILL_SHAPE
+        FULL_DRILL_SHAPE = pcbnew.DRILL_MARKS_FULL_DRILL_SHAPE
+    elif hasattr(pcbnew, 'PCB_PLOT_PARAMS'):
+        NO_DRILL_SHAPE = pcbnew.PCB_PLOT_PARAMS.NO_DRILL_SHAPE
+        SMALL_DRILL_SHAPE = pcbnew.PCB_PLOT_PARAMS.SMALL_DRILL_SHAPE
+        FULL_DRILL_SHAPE = pcbnew.PCB_PLOT_PARAMS.FULL_DRILL_SHAPE
+
+
 def SetExcludeEdgeLayer(po, exclude_edge_layer, layer):
     if hasattr(po, 'SetExcludeEdgeLayer'):
         po.SetExcludeEdgeLayer(exclude_edge_layer)
@@ -135,63 +239,172 @@ def SetExcludeEdgeLayer(po, exclude_edge_layer, layer):
             po.SetPlotOnAllLayersSelection(include)
 
 
-def WriteBBox(board, hash_dir):
-    fname = '{}{}bbox.csv'.format(hash_dir, sep)
-    if isfile(fname):
+def GetBoard(file):
+    """ Load a PCB, only once """
+    board = loaded_boards.get(file)
+    if board is None:
+        board = pcbnew.LoadBoard(file)
+        if hasattr(pcbnew, 'LAYER_HIDDEN_TEXT'):
+            # KiCad 8.0.2 crazyness: hidden text affects scaling, even when not plotted
+            # So a PRL can affect the plot mechanism
+            board.SetElementVisibility(pcbnew.LAYER_HIDDEN_TEXT, False)
+        loaded_boards[file] = board
+    return board
+
+
+def WriteBBox(file, hash_dir):
+    vals = CacheGetValue(hash_dir, 'bbox')
+    if vals is not None:
         # Use the cached value if available, in cache mode the file can be bogus
-        with open(fname, 'rt') as f:
-            vals = tuple(map(float, f.read().split(',')))
-    else:
-        bbox = board.GetBoundingBox()
-        vals = tuple(map(ToMM, (bbox.GetX(), bbox.GetY(), bbox.GetWidth(), bbox.GetHeight())))
-        with open(fname, 'wt') as f:
-            f.write(','.join(tuple(map(str, vals))))
+        return tuple(vals)
+    # Only load the PCB if we need it
+    bbox = GetBoard(file).GetBoundingBox()
+    makedirs(hash_dir, exist_ok=True)
+    vals = tuple(map(pcbnew.ToMM, (bbox.GetX(), bbox.GetY(), bbox.GetWidth(), bbox.GetHeight())))
+    CacheSetValue(hash_dir, 'bbox', vals)
     return vals
 
 
+def GetBBox(file, file_hash):
+    return WriteBBox(file, cache_dir+sep+file_hash)
+
+
+def BBoxChanged(bbox_old, bbox_new):
+    """ When the bounding boxes are different we must use the plots at scale 1 """
+    zero_size = (0, 0, 0, 0)
+    return bbox_old != bbox_new and bbox_old != zero_size and bbox_new != zero_size
+
+
+def GetCropWindow(bbox_old, bbox_new):
+    """ Area of the page containing both PCBs, plus a margin. In pixels.
+        Only valid for the 1:1 plots, where the PCB coordinates are the page coordinates. """
+    bboxes = [b for b in (bbox_old, bbox_new) if b[2] and b[3]]
+    if not bboxes:
+        return None
+    x1 = min(b[0] for b in bboxes)-CROP_MARGIN
+    y1 = min(b[1] for b in bboxes)-CROP_MARGIN
+    x2 = max(b[0]+b[2] for b in bboxes)+CROP_MARGIN
+    y2 = max(b[1]+b[3] for b in bboxes)+CROP_MARGIN
+    to_px = resolution/25.4
+    x = max(int(x1*to_px), 0)
+    y = max(int(y1*to_px), 0)
+    return (x, y, int(x2*to_px+1)-x, int(y2*to_px+1)-y)
+
+
+def SelectFlavor(bbox_old, bbox_new):
+    """ Decide if we must use the 1:1 plots. Also computes the area to crop """
+    global crop_window
+    if not args.crop:
+        return BBoxChanged(bbox_old, bbox_new)
+    # Cropping needs the 1:1 plots
+    crop_window = GetCropWindow(bbox_old, bbox_new)
+    logger.debug('Cropping the pages to {}'.format(crop_window))
+    return True
+
+
 def compress_svg(name):
     if not use_scour:
         return
-    tmp = name+'.compressed'
+    tmp = tmp_name(name)
     run_command(['scour', '-i', name, '-o', tmp, '--enable-viewboxing', '--enable-id-stripping', '--enable-comment-stripping',
                  '--shorten-ids', '--indent=none'])
-    rename(tmp, name)
+    replace(tmp, name)
+
+
+def CacheDB():
+    """ Connection to the cache index.
+        sqlite3 connections can't be shared by threads, or inherited by the workers, so we use one for each """
+    key = (getpid(), get_ident(), cache_dir)
+    db = cache_dbs.get(key)
+    if db is None:
+        # Autocommit, other runs can share the cache. Wait if they are writing.
+        db = sqlite3.connect(cache_dir+sep+CACHE_DB, timeout=60, isolation_level=None)
+        db.execute('CREATE TABLE IF NOT EXISTS artifacts (hash TEXT NOT NULL, kind TEXT NOT NULL, layer TEXT NOT NULL, '
+                   'flavor TEXT NOT NULL, resolution INTEGER NOT NULL, ops TEXT NOT NULL, value TEXT, '
+                   'PRIMARY KEY (hash, kind, layer, flavor, resolution))')
+        db.execute('CREATE TABLE IF NOT EXISTS entries (hash TEXT PRIMARY KEY, last_used REAL NOT NULL, size INTEGER)')
+        if 'size' not in (c[1] for c in db.execute('PRAGMA table_info(entries)')):
+            # Index created by an older version
+            db.execute('ALTER TABLE entries ADD COLUMN size INTEGER')
+        db.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT NOT NULL, normalized INTEGER NOT NULL, '
+                   'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, digest TEXT NOT NULL, '
+                   'PRIMARY KEY (path, normalized))')
+        cache_dbs[key] = db
+    return db
+
+
+def CacheKey(name):
+    """ Hash and name relative to the cache entry for a file in the cache """
+    rel = relpath(name, cache_dir).split(sep, 1)
+    return rel[0], rel[1] if len(rel) > 1 else ''
+
+
+def OpsDigest(ops):
+    return sha1(json.dumps(ops, sort_keys=True).encode()).hexdigest()
+
+
+def CacheSet(name, kind, ops='', flavor='', res=0, value=None):
+    """ Record a cache artifact, `name` is the file (or the hash dir for per-entry data) """
+    file_hash, layer = CacheKey(name)
+    CacheDB().execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (file_hash, kind, layer, flavor, res, ops, None if value is None else json.dumps(value)))
 
 
-def GetOpsName(name):
-    return dirname(name)+sep+'.'+basename(name)+'.json'
+def CacheGet(name, kind, flavor='', res=0):
+    """ Look for an artifact, returns (ops, value) or None """
+    file_hash, layer = CacheKey(name)
+    row = CacheDB().execute('SELECT ops, value FROM artifacts WHERE hash=? AND kind=? AND layer=? AND flavor=? AND '
+                            'resolution=?', (file_hash, kind, layer, flavor, res)).fetchone()
+    if row is None:
+        return None
+    return row[0], None if row[1] is None else json.loads(row[1])
+
+
+def CacheSetValue(hash_dir, kind, value):
+    CacheSet(hash_dir, kind, value=value)
+
+
+def CacheGetValue(hash_dir, kind):
+    row = CacheGet(hash_dir, kind)
+    return None if row is None else row[1]
+
+
+def CacheRemoveEntry(file_hash):
+    db = CacheDB()
+    db.execute('DELETE FROM artifacts WHERE hash=?', (file_hash,))
+    db.execute('DELETE FROM entries WHERE hash=?', (file_hash,))
 
 
 def WriteOptions(name, ops):
-    name_ops = GetOpsName(name)
-    logger.debug('Writing options used for `{}` as `{}` ({})'.format(name, name_ops, ops))
-    with open(name_ops, 'wt') as f:
-        f.write(json.dumps(ops))
+    logger.debug('Writing options used for `{}` ({})'.format(name, ops))
+    CacheSet(name, 'plot', OpsDigest(ops))
+
+
+def GetOptions(name):
+    """ Digest of the options used to plot `name`, None if we didn't plot it """
+    row = CacheGet(name, 'plot')
+    return None if row is None else row[0]
 
 
 def CheckOptions(name, cur_ops):
-    name_ops = GetOpsName(name)
-    if not isfile(name_ops):
+    ops = GetOptions(name)
+    if ops is None:
         logger.debug('No options for cache entry: '+name)
         return False
-    res = json.load(open(name_ops, 'rt')) == cur_ops
+    res = ops == OpsDigest(cur_ops)
     logger.debug('Options for cache entry `{}` are the same as current: {}'.format(name, res))
     return res
 
 
-def GenPCBImages(board, file_hash, hash_dir, file_no_ext, layer_names, wanted_layers, kiri_mode, zones_ops):
+def GenPCBImages(board, file_hash, hash_dir, file_no_ext, layer_names, wanted_layers, kiri_mode, zones_ops, scaled):
     # Setup the KiCad plotter
-    if hasattr(pcbnew, 'LAYER_HIDDEN_TEXT'):
-        # KiCad 8.0.2 crazyness: hidden text affects scaling, even when not plotted
-        # So a PRL can affect the plot mechanism
-        board.SetElementVisibility(pcbnew.LAYER_HIDDEN_TEXT, False)
-    pctl = PLOT_CONTROLLER(board)
+    pctl = pcbnew.PLOT_CONTROLLER(board)
     popt = pctl.GetPlotOptions()
     popt.SetOutputDirectory(abspath(hash_dir))  # abspath: Otherwise it will be relative to the file
     # Options
     # KiCad 5 only
     if kicad_version_major == 5:
-        popt.SetLineWidth(FromMM(0.35))
+        popt.SetLineWidth(pcbnew.FromMM(0.35))
         popt.SetPlotFrameRef(False)
     else:
         popt.SetPlotFrameRef(kiri_mode)
@@ -207,28 +420,39 @@ def GenPCBImages(board, file_hash, hash_dir, file_no_ext, layer_names, wanted_la
     if zones_ops != 'none':
         zones = board.Zones()
         if zones_ops == 'fill':
-            ZONE_FILLER(board).Fill(zones)
+            pcbnew.ZONE_FILLER(board).Fill(zones)
         elif zones_ops == 'unfill':
             for z in zones:
                 z.UnFill()
 
     if kiri_mode:
-        flavors = 1
+        flavors = (0,)
         extension = 'svg'
-        plot_format = PLOT_FORMAT_SVG
+        plot_format = pcbnew.PLOT_FORMAT_SVG
         dir_name = hash_dir+sep+'_KIRI_'+sep+'pcb'
         makedirs(dir_name, exist_ok=True)
         file_pattern = dir_name+sep+'layer-%02d%s.'+extension
     else:
-        flavors = 2
+        # We can create 2 versions: one with autoscale and the other without it
+        # If the BBox is the same we use the scaled one, otherwise we use the non-scaled
+        # Only the one we need is plotted, unless we are just populating the cache
+        flavors = (0, 1) if scaled is None else (int(scaled),)
         extension = 'pdf'
-        plot_format = PLOT_FORMAT_PDF
+        plot_format = pcbnew.PLOT_FORMAT_PDF
         file_pattern = hash_dir+sep+'%d%s.'+extension
 
+    # Names from the PCB, the names we return also include the standard name
+    pcb_names = dict(layer_names)
+    if not kiri_mode:
+        for i, layer in wanted_layers.items():
+            layer_name = layer_names.get(i)
+            if layer_name is not None and layer_name != layer:
+                layer_names[i] = '{} ({})'.format(layer_name, layer)
+    if plot_notify is not None:
+        plot_notify(('layers', layer_names))
+
     # Plot all used layers to PDF files
-    for scaled in range(flavors):
-        # We create 2 versions: one with autoscale and the other without it
-        # If the BBox is the same we use the scaled one, otherwise we use the non-scaled
+    for scaled in flavors:
         sc_id = ''
         if scaled:
             popt.SetAutoScale(True)
@@ -242,20 +466,24 @@ def GenPCBImages(board, file_hash, hash_dir, file_no_ext, layer_names, wanted_la
             if i not in layer_names:
                 # This layer was removed, don't plot it
                 continue
+            if pcb_names[i] in unchanged_layers:
+                logger.debug('Skipping unchanged {} layer'.format(layer))
+                continue
             layer_rep = layer.replace('.', '_')
             name_pdf_kicad = '{}{}{}-{}.{}'.format(hash_dir, sep, file_no_ext, layer_rep, extension)
             name_pdf = file_pattern % (i, sc_id)
             # Create the PDF, or use a cached version
             if not CheckOptions(name_pdf, cur_pcb_ops) or not isfile(name_pdf):
+                WriteLockCacheEntry(hash_dir)
                 logger.info('Plotting %s layer' % layer)
                 # Plot the edge before, no drill marks (8.0.4 added them)
-                pctl.SetLayer(Edge_Cuts)
+                pctl.SetLayer(pcbnew.Edge_Cuts)
                 popt.SetDrillMarksType(NO_DRILL_SHAPE)
                 pctl.OpenPlotfile(layer, plot_format, layer)
                 pctl.PlotLayer()
                 # Plot the real layer, disable drill marks in silk screen (8.0.4 added them)
                 pctl.SetLayer(i)
-                popt.SetDrillMarksType(SMALL_DRILL_SHAPE if IsCopperLayer(i) else NO_DRILL_SHAPE)
+                popt.SetDrillMarksType(SMALL_DRILL_SHAPE if pcbnew.IsCopperLayer(i) else NO_DRILL_SHAPE)
                 pctl.PlotLayer()
                 pctl.ClosePlot()
                 if not isfile(name_pdf_kicad):
@@ -265,43 +493,65 @@ def GenPCBImages(board, file_hash, hash_dir, file_no_ext, layer_names, wanted_la
                 if kiri_mode:
                     compress_svg(name_pdf)
                 WriteOptions(name_pdf, cur_pcb_ops)
+                if kiri_mode or not queue_pdf2png(splitext(name_pdf)[0], i):
+                    plot_ready(i)
             else:
                 logger.debug('Using cached {} layer'.format(layer))
-            if scaled:
-                layer_name = layer_names[i]
-                if layer_name != layer:
-                    layer_names[i] = '{} ({})'.format(layer_name, layer)
-    return kiri_mode or WriteBBox(board, hash_dir)
+                plot_ready(i)
 
 
 def GenSCHImageDirect(file, file_hash, hash_dir, file_no_ext, layer_names, all):
     """ Plot the schematic in one PDF file """
     name_pdf = hash_dir+sep+layer_names[0]+'.pdf'
-    name_ops = hash_dir+sep+'options'
     # Create the PDF, or use a cached version
-    if not CheckOptions(name_ops, cur_sch_ops) or not isfile(name_pdf):
+    if not CheckOptions(name_pdf, cur_sch_ops) or not isfile(name_pdf):
+        WriteLockCacheEntry(hash_dir)
         logger.info('Plotting the schematic')
         cmd = ['eeschema_do']
         if VERB:
             cmd.append(VERB)
-        cmd.extend(['export', '--file_format', 'pdf', '--monochrome', '--no_frame', '--output_name', name_pdf])
+        tmp = tmp_name(name_pdf)
+        cmd.extend(['export', '--file_format', 'pdf', '--monochrome', '--no_frame', '--output_name', tmp])
         if all:
             cmd.append('--all_pages')
         cmd.extend([file, '.'])
         logger.debug('Executing: '+str(cmd))
         res = call(cmd)
         logger.debug(res)
-        if not isfile(name_pdf):
+        if not isfile(tmp):
             logger.error('Failed to plot %s' % name_pdf)
             exit(FAILED_TO_PLOT)
-        WriteOptions(name_ops, cur_sch_ops)
+        replace(tmp, name_pdf)
+        WriteOptions(name_pdf, cur_sch_ops)
     else:
         logger.debug('Using cached schematic')
 
 
+def svg_flavor():
+    """ The PNGs converted from SVGs are keyed by the converter, the color mode and the resolution """
+    return '{}_{}_{}dpi'.format('cairosvg' if has_cairosvg else 'rsvg-convert', 'mono' if args.mono else 'color',
+                                resolution)
+
+
 def svg2png(svg_file, png_file):
-    cmd = ['rsvg-convert', '-d', str(resolution), '-p', str(resolution), '-f', 'png', '-b', 'white', '-o', png_file, svg_file]
-    run_command(cmd)
+    tmp = tmp_name(png_file)
+    if has_cairosvg:
+        logger.debug('Converting {} to {} using CairoSVG'.format(svg_file, png_file))
+        cairosvg.svg2png(url=svg_file, write_to=tmp, dpi=resolution, background_color='white')
+    else:
+        cmd = ['rsvg-convert', '-d', str(resolution), '-p', str(resolution), '-f', 'png', '-b', 'white', '-o', tmp,
+               svg_file]
+        run_command(cmd)
+        if not isfile(tmp):
+            return
+    if args.mono:
+        # Black and white, like the bitmaps we get from the PDFs
+        if has_numpy:
+            with Image.open(tmp) as img:
+                pil_mono(img).save(tmp)
+        else:
+            run_command(['bash', '-c', CONVERT+' "{0}" -colorspace Gray -threshold 50% -type bilevel "{0}"'.format(tmp)])
+    replace(tmp, png_file)
 
 
 def GenSCHImageSVG(file, file_hash, hash_dir, file_no_ext, layer_names, kiri_mode):
@@ -316,7 +566,10 @@ def GenSCHImageSVG(file, file_hash, hash_dir, file_no_ext, layer_names, kiri_mod
     files = glob(pattern_pngs)
     # Create the PNG, or use a cached version
     ops_changed = not CheckOptions(name_ops, cur_sch_ops)
-    if ops_changed or not files:
+    # The PNGs are converted again if the converter, the color mode or the resolution changed
+    png_flavor = CacheGet(name_ops, 'svg2png')
+    if ops_changed or not files or (not kiri_mode and (png_flavor is None or png_flavor[1] != svg_flavor())):
+        WriteLockCacheEntry(hash_dir)
         svgs = glob(pattern_svgs)
         if ops_changed or not svgs:
             logger.info('Plotting the schematic')
@@ -347,6 +600,7 @@ def GenSCHImageSVG(file, file_hash, hash_dir, file_no_ext, layer_names, kiri_mod
                 else:
                     logger.warning('Unexpected file `{}`'.format(f))
             files = glob(pattern_pngs)
+            CacheSet(name_ops, 'svg2png', value=svg_flavor())
         WriteOptions(name_ops, cur_sch_ops)
     else:
         logger.debug('Using cached schematic')
@@ -367,25 +621,27 @@ def GenSCHImage(file, file_hash, hash_dir, file_no_ext, layer_names, all, kiri_m
         GenSCHImageDirect(file, file_hash, hash_dir, file_no_ext, layer_names, all)
 
 
-def GenImages(file, file_hash, all, zones, kiri_mode=False):
+def GenImages(file, file_hash, all, zones, kiri_mode=False, scaled=None):
     # Check if we have a valid cache
     hash_dir = cache_dir+sep+file_hash
     logger.debug('Cache for {} will be {}'.format(file, hash_dir))
     if isdir(hash_dir):
         logger.info('cache dir for `%s` already exists' % file)
+    TouchCacheEntry(hash_dir)
 
     file_no_ext = splitext(basename(file))[0]
 
     # Read the layer names from the file
     if is_pcb:
-        board = LoadBoard(file)
+        board = GetBoard(file)
         # This code exposes the fails in KiCad API for tests/board_samples/kicad_8/light_control.kicad_pcb
         # for la in board.GetEnabledLayers().Seq():
         #     logger.debug(f'{la} -> {board.GetLayerName(la)} ({board.GetStandardLayerName(la)})')
         layer_names, wanted_layers = load_layer_names(file, hash_dir, kiri_mode)
         logger.debug('Layers list: '+str(layer_names))
         logger.debug('Wanted layers: '+str(wanted_layers))
-        res = GenPCBImages(board, file_hash, hash_dir, file_no_ext, layer_names, wanted_layers, kiri_mode, zones)
+        GenPCBImages(board, file_hash, hash_dir, file_no_ext, layer_names, wanted_layers, kiri_mode, zones, scaled)
+        res = kiri_mode or WriteBBox(file, hash_dir)
     else:
         layer_names = {0: 'Schematic_all' if args.all_pages else 'Schematic'}
         GenSCHImage(file, file_hash, hash_dir, file_no_ext, layer_names, all, kiri_mode)
@@ -394,6 +650,118 @@ def GenImages(file, file_hash, all, zones, kiri_mode=False):
     return layer_names, res
 
 
+def GenImagesWorker(conn, file, file_hash, *job):
+    """ Runs GenImages in a child process.
+        We first send the bounding box of the PCB and then wait to know which flavor we must plot.
+        Then we send the layers of the PCB, each layer as soon as it's ready and a final `done`.
+        The messages are sent using `conn` """
+    global in_worker
+    global crop_window
+    global plot_notify
+    in_worker = True
+    lock = Lock()
+
+    def notify(msg):
+        # The background conversions also notify
+        with lock:
+            conn.send(msg)
+
+    try:
+        conn.send(GetBBox(file, file_hash))
+        scaled, crop_window = conn.recv()
+        plot_notify = notify
+        GenImages(file, file_hash, *job, scaled=scaled)
+        wait_all_pdf2png()
+        notify(('done', None))
+    finally:
+        conn.close()
+
+
+def plot_ready(layer):
+    """ Tell the parent process this layer is ready to be compared (see GenImagesWorker) """
+    if plot_notify is not None:
+        plot_notify(('ready', layer))
+
+
+def GenImagesParallel(old_job, new_job):
+    """ Run GenImages for the old and new PCBs using separated processes.
+        pcbnew isn't thread safe, so we use one process for each file, each one using its own hash_dir.
+        We fork, so the children inherit the current configuration, including the locked cache entries.
+        Returns the layers, the flavor and a function to wait until a layer is ready, so the diffs can be computed
+        while plotting. """
+    ctx = get_context('fork')
+    procs = []
+    for job in (old_job, new_job):
+        conn, child_conn = ctx.Pipe()
+        p = ctx.Process(target=GenImagesWorker, args=(child_conn,)+job)
+        p.start()
+        child_conn.close()
+        procs.append((p, conn))
+
+    def failed(p):
+        """ The child already reported the problem """
+        p.join()
+        for other, _ in procs:
+            if other.is_alive():
+                other.terminate()
+        return p.exitcode or FAILED_TO_PLOT
+
+    def receive():
+        results = []
+        for p, conn in procs:
+            try:
+                results.append(conn.recv())
+            except EOFError:
+                exit(failed(p))
+        return results
+
+    changed = SelectFlavor(*receive())
+    for _, conn in procs:
+        try:
+            conn.send((not changed, crop_window))
+        except BrokenPipeError:
+            # Will be reported by receive()
+            pass
+    (_, layers_old), (_, layers_new) = receive()
+
+    # Collect the layers as they are ready, (side, None) means all the layers are ready
+    cond = Condition()
+    ready = set()
+    error = []
+
+    def collect():
+        pending = {conn: n for n, (_, conn) in enumerate(procs)}
+        while pending:
+            for conn in wait_connections(list(pending)):
+                n = pending[conn]
+                try:
+                    kind, layer = conn.recv()
+                except EOFError:
+                    kind, layer = 'failed', failed(procs[n][0])
+                with cond:
+                    if kind == 'ready':
+                        ready.add((n, layer))
+                    else:
+                        ready.add((n, None))
+                        del pending[conn]
+                        if kind == 'failed':
+                            error.append(layer)
+                    cond.notify_all()
+        for p, _ in procs:
+            p.join()
+
+    Thread(target=collect, daemon=True).start()
+
+    def wait_layer(n, layer=None):
+        """ Wait until the `layer` of the old (0) or new (1) PCB is ready, None is all the layers """
+        with cond:
+            cond.wait_for(lambda: (n, layer) in ready or (n, None) in ready)
+            if error:
+                exit(error[0])
+
+    return layers_old, layers_new, changed, wait_layer
+
+
 def run_command(command):
     logger.debug('Executing: '+shlex.join(command))
     try:
@@ -409,41 +777,471 @@ def run_command(command):
     return res
 
 
-def pdf2png(base_name, blank=False, ref=None):
+def pdftoppm_crop():
+    if crop_window is None:
+        return []
+    return ['-x', str(crop_window[0]), '-y', str(crop_window[1]), '-W', str(crop_window[2]), '-H', str(crop_window[3])]
+
+
+def pdftoppm_mode():
+    return '-mono' if args.mono else '-gray'
+
+
+def pdf2png_pdftoppm(source, dest):
+    crop = ' '.join(pdftoppm_crop())
+    cmd = 'cat "{}" | pdftoppm -r {} {} {} - | {} - "{}"'.format(source, resolution, crop, pdftoppm_mode(), CONVERT, dest)
+    run_command(['bash', '-c', cmd])
+
+
+def pdf2png_gs(source, dest):
+    """ ImageMagick using Ghostscript """
+    crop = ' -crop {2}x{3}+{0}+{1} +repage'.format(*crop_window) if crop_window is not None else ''
+    cmd = (CONVERT + ' -density {} "{}" -background white -alpha remove -alpha off -threshold 50% '
+           '-colorspace Gray -resample {}{} -depth 8 "{}"'.format(resolution*2, source, resolution, crop, dest))
+    run_command(['bash', '-c', cmd])
+
+
+def pdf2array_pdfium(source):
+    """ In-process conversion, returns a grayscale array for each page (bit-packed for --mono) """
+    with pdfium_lock:
+        logger.debug('Converting {} using pdfium'.format(source))
+        pdf = pdfium.PdfDocument(source)
+        try:
+            pages = []
+            for page in pdf:
+                crop = (0, 0, 0, 0)
+                if crop_window is not None:
+                    # pdfium crops using points, from each side of the page (left, bottom, right, top)
+                    # We add an extra pixel to the right and bottom, to reduce the rounding errors
+                    w, h = page.get_size()
+                    px = 72/resolution
+                    x, y, cw, ch = (v*px for v in crop_window)
+                    crop = (x, max(h-y-ch-px, 0), max(w-x-cw-px, 0), y)
+                bitmap = page.render(scale=resolution/72, grayscale=True, crop=crop)
+                img = bitmap.to_numpy()
+                if crop_window is not None:
+                    # Make the size exactly the requested
+                    res = np.full((crop_window[3], crop_window[2]), 255, dtype=np.uint8)
+                    h, w = min(img.shape[0], res.shape[0]), min(img.shape[1], res.shape[1])
+                    res[:h, :w] = img[:h, :w]
+                    img = res
+                pages.append(np_pack(img) if args.mono else img.copy())
+                # Release the PDFium objects now, not when collected (maybe in other thread)
+                bitmap.close()
+                page.close()
+            return pages
+        finally:
+            pdf.close()
+
+
+# Color mode of the bitmaps created by each rasterizer (see raster_mode)
+RASTER_MODE = {'pdftoppm': 'gray', 'gs': 'mono', 'pdfium': 'gray'}
+# Rasterizers that create PNG files: function(source, dest)
+PDF2PNG = {'pdftoppm': pdf2png_pdftoppm, 'gs': pdf2png_gs}
+# In-process rasterizers, they return arrays, used by the NumPy engine: function(source) -> [array]
+PDF2ARRAY = {'pdfium': pdf2array_pdfium}
+
+
+# Raw rasters (see --raster_format): magic, width, height, resolution, bits per pixel, crop offset (x, y)
+RAW_HEADER = '<8sIIIIii'
+RAW_MAGIC = b'KIDIFFR1'
+
+
+def raw_header(width, height, bits):
+    x, y = crop_window[:2] if crop_window is not None else (0, 0)
+    return pack(RAW_HEADER, RAW_MAGIC, width, height, resolution, bits, x, y)
+
+
+def write_raw(name, data, width, bits):
+    """ Store a raster as an uncompressed array, 8 bits gray or bit-packed (1 is ink) """
+    with atomic_open(name, 'wb') as f:
+        f.write(raw_header(width, data.shape[0], bits))
+        f.write(np.ascontiguousarray(data, dtype=np.uint8).tobytes())
+
+
+def pnm_header(f):
+    """ Read the header of a PGM/PBM image, returns the type, width and height.
+        None at the end of the stream, False if the header isn't valid """
+    tokens = []
+    while len(tokens) < (2 if tokens and tokens[0] == b'P4' else 3) + 1:
+        c = f.read(1)
+        while c.isspace():
+            c = f.read(1)
+        if not c:
+            return False if tokens else None
+        if c == b'#':
+            f.readline()
+            continue
+        token = c
+        c = f.read(1)
+        while c and not c.isspace():
+            token += c
+            c = f.read(1)
+        tokens.append(token)
+    if tokens[0] not in (b'P4', b'P5') or (tokens[0] == b'P5' and tokens[3] != b'255'):
+        return False
+    try:
+        return tokens[0], int(tokens[1]), int(tokens[2])
+    except ValueError:
+        return False
+
+
+def pdf2raw_failed(source, tmps, msg):
+    for tmp in tmps:
+        if isfile(tmp):
+            remove(tmp)
+    logger.error('{} {} using pdftoppm'.format(msg, source))
+    exit(FAILED_TO_CONVERT)
+
+
+def pdf2raw_pdftoppm(source, dest):
+    """ Convert a PDF to raw rasters, copying the pdftoppm output (PGM or PBM) to the files.
+        No need to decode the whole image. Returns the list of files, one for each page """
+    cmd = ['pdftoppm', '-r', str(resolution)]+pdftoppm_crop()+[pdftoppm_mode(), source]
+    logger.debug('Executing: '+shlex.join(cmd))
+    tmps = []
+    with Popen(cmd, stdout=PIPE) as p:
+        while True:
+            head = pnm_header(p.stdout)
+            if head is None:
+                break
+            if not head:
+                pdf2raw_failed(source, tmps, 'Malformed output converting')
+            kind, w, h = head
+            bits = 1 if kind == b'P4' else 8
+            # PBM uses 1 for black, like us
+            size = h*((w+7)//8 if bits == 1 else w)
+            tmp = tmp_name(splitext(dest)[0]+'-{}.raw'.format(len(tmps)))
+            with open(tmp, 'wb') as f:
+                f.write(raw_header(w, h, bits))
+                while size:
+                    data = p.stdout.read(min(size, DIGEST_BUFFER))
+                    if not data:
+                        tmps.append(tmp)
+                        pdf2raw_failed(source, tmps, 'Truncated output converting')
+                    f.write(data)
+                    size -= len(data)
+            tmps.append(tmp)
+    if p.returncode or not tmps:
+        pdf2raw_failed(source, tmps, 'Failed to convert')
+    raws = [dest] if len(tmps) == 1 else [splitext(dest)[0]+'-{}.raw'.format(n) for n in range(len(tmps))]
+    for tmp, raw in zip(tmps, raws):
+        replace(tmp, raw)
+    return raws
+
+
+def np_load_raw(name):
+    """ Memory map a raw raster, returns the array (rows), the width in pixels and the bits per pixel """
+    offset = calcsize(RAW_HEADER)
+    with open(name, 'rb') as f:
+        header = f.read(offset)
+    if len(header) < offset or header[:len(RAW_MAGIC)] != RAW_MAGIC:
+        logger.error('Invalid raw raster '+name)
+        exit(FAILED_TO_CONVERT)
+    _, w, h, _, bits, _, _ = unpack(RAW_HEADER, header)
+    stride = (w+7)//8 if bits == 1 else w
+    if getsize(name) < offset+h*stride:
+        logger.error('Truncated raw raster '+name)
+        exit(FAILED_TO_CONVERT)
+    return np.memmap(name, dtype=np.uint8, mode='r', offset=offset, shape=(h, stride)), w, bits
+
+
+def png2raw(png):
+    """ Replace a PNG by a raw raster, so the next runs doesn't need to decode it """
+    raw = splitext(png)[0]+'.raw'
+    if args.mono:
+        packed, w = np_load_packed(png)
+        write_raw(raw, packed, w, 1)
+    else:
+        gray = np_load_gray(png)
+        write_raw(raw, gray, gray.shape[1], 8)
+    remove(png)
+    return raw
+
+
+def raster_mode():
+    return 'mono' if args.mono else RASTER_MODE[RASTERIZER]
+
+
+def raster_flavor():
+    """ The cached PNGs are keyed by the rasterizer, its color mode, the cropped area and the resolution """
+    flavor = '{}_{}'.format(RASTERIZER, raster_mode())
+    if args.raster_format == 'raw':
+        flavor += '_raw'
+    if crop_window is not None:
+        flavor += '_crop{2}x{3}+{0}+{1}'.format(*crop_window)
+    return flavor
+
+
+def png_name(base_name, res=None):
+    """ Name of the PNG for a PDF, so PNGs for different resolutions and rasterizers can coexist """
+    return '{}_{}dpi_{}.png'.format(base_name, res or resolution, raster_flavor())
+
+
+def reduced_flavor(res):
+    """ Flavor for the PNGs created reducing the PNGs for a higher resolution """
+    return raster_flavor()+'_from{}dpi'.format(res)
+
+
+def GetPNGs(base_name, source, reduce_from=None):
+    """ PNGs for `source`, created by a previous run. None if they aren't valid.
+        They are valid if created from a plot using the current options, the same resolution and rasterizer.
+        Using `reduce_from` we get the PNGs reduced from this resolution, created if needed. """
+    ops = GetOptions(source)
+    if ops is None:
+        return None
+    flavor = raster_flavor() if reduce_from is None else reduced_flavor(reduce_from)
+    row = CacheGet(base_name, 'png', flavor, resolution)
+    if row is not None and row[0] == ops:
+        pngs = [join(dirname(base_name), n) for n in row[1]]
+        if all(map(isfile, pngs)):
+            return pngs
+    return None if reduce_from is None else downsample_pngs(base_name, ops, reduce_from)
+
+
+def SetPNGs(base_name, ops, pngs, flavor=None):
+    CacheSet(base_name, 'png', ops, flavor or raster_flavor(), resolution, [basename(n) for n in pngs])
+
+
+def reduce_sources(base_name):
+    """ Higher resolutions we have in the cache and we can reduce to get the PNGs for `base_name` """
+    if not has_numpy or crop_window is not None or raster_mode() != 'gray' or args.raster_format != 'png':
+        return {}
+    ops = GetOptions(base_name+'.pdf')
+    if ops is None:
+        return {}
+    file_hash, layer = CacheKey(base_name)
+    rows = CacheDB().execute('SELECT resolution, value FROM artifacts WHERE hash=? AND kind=? AND layer=? AND flavor=? AND '
+                             'ops=? AND resolution>? AND resolution%?=0',
+                             (file_hash, 'png', layer, raster_flavor(), ops, resolution, resolution)).fetchall()
+    sources = {}
+    for res, value in rows:
+        srcs = [join(dirname(base_name), n) for n in json.loads(value)]
+        if all(map(isfile, srcs)):
+            sources[res] = srcs
+    return sources
+
+
+def pair_reduce_from(old_file, new_file):
+    """ Resolution we reduce to get both sides of a layer, None if they must be converted.
+        A reduced bitmap isn't identical to a converted one, so both sides must be created in the same way """
+    for base_name in (old_file, new_file):
+        if base_name in raster_jobs or GetPNGs(base_name, base_name+'.pdf') is not None:
+            return None
+    common = reduce_sources(old_file).keys() & reduce_sources(new_file).keys()
+    return min(common) if common else None
+
+
+def downsample_pngs(base_name, ops, res):
+    """ Create the PNGs reducing the PNGs for a higher resolution, if we have them.
+        Only integer factors are used, the size is the same we get converting the PDF (both round up). """
+    srcs = reduce_sources(base_name).get(res)
+    if srcs is None:
+        return None
+    logger.debug('Creating the {} DPI PNGs for {} from the {} DPI PNGs'.format(resolution, base_name, res))
+    WriteLockCacheEntry(base_name)
+    src_base = splitext(png_name(base_name, res))[0]
+    dest_base = splitext(png_name(base_name))[0]+'_from{}dpi'.format(res)
+    pngs = []
+    for src in srcs:
+        # Keep the page suffix, if any
+        dest = dest_base+splitext(src)[0][len(src_base):]+'.png'
+        with Image.open(src) as img:
+            small = img.convert('L').reduce(res//resolution)
+        tmp = tmp_name(dest)
+        small.save(tmp, 'PNG')
+        replace(tmp, dest)
+        pngs.append(dest)
+    SetPNGs(base_name, ops, pngs, reduced_flavor(res))
+    return pngs
+
+
+def commit_pngs(tmp, dest):
+    """ Move the PNGs created using a temporal name to its final name.
+        Multi-page documents generate one file for each page (-N suffix) """
+    if isfile(tmp):
+        replace(tmp, dest)
+        return
+    tmp_base = splitext(tmp)[0]
+    dest_base = splitext(dest)[0]
+    for f in glob(tmp_base+'-*.png'):
+        replace(f, dest_base+f[len(tmp_base):])
+
+
+def pdf2png(base_name, blank=False, ref=None, reduce_from=None):
+    """ Convert a PDF to bitmaps, one for each page.
+        Returns a list of PNG names, or arrays when using an in-process rasterizer """
     source = base_name+'.pdf' if not blank else ref+'.pdf'
-    source_mtime = getmtime(source) if isfile(source) else 0
-    dest1 = base_name+'.png'
-    destm = base_name+'-0.png'
-    if isfile(dest1) and getmtime(dest1) > source_mtime:
-        logger.debug(source+" already converted to PNG")
-        return [dest1]
-    if isfile(destm) and getmtime(dest1) > source_mtime:
-        logger.debug(source+" already converted to PNG")
-        return sorted(glob(base_name+'-*.png'))
+    dest1 = png_name(base_name)
+    destm = splitext(dest1)[0]+'-0.png'
+    if not isfile(source):
+        # Not a plot, i.e. the PNGs from SVGs
+        if isfile(base_name+'.png'):
+            return [base_name+'.png']
+    elif not blank:
+        pngs = GetPNGs(base_name, source, reduce_from)
+        if pngs is not None:
+            logger.debug(source+" already converted to PNG")
+            return pngs
     if isfile(source):
-        if use_poppler:
-            cmd = 'cat "{}" | pdftoppm -r {} -gray - | {} - "{}"'.format(source, resolution, CONVERT, dest1)
-        else:
-            cmd = (CONVERT + ' -density {} "{}" -background white -alpha remove -alpha off -threshold 50% '
-                   '-colorspace Gray -resample {} -depth 8 "{}"'.format(resolution*2, source, resolution, dest1))
-        run_command(['bash', '-c', cmd])
+        if RASTERIZER in PDF2ARRAY:
+            pages = PDF2ARRAY[RASTERIZER](source)
+            if blank:
+                pages = [(np.zeros_like(page[0]), page[1]) if args.mono else np.full_like(page, 255) for page in pages]
+            elif args.raster_format == 'raw':
+                WriteLockCacheEntry(base_name)
+                store_raw_pages(base_name, source, pages)
+            return pages
+        WriteLockCacheEntry(base_name)
+        if args.raster_format == 'raw' and RASTERIZER == 'pdftoppm' and not blank:
+            raws = pdf2raw_pdftoppm(source, splitext(dest1)[0]+'.raw')
+            ops = GetOptions(source)
+            if ops is not None:
+                SetPNGs(base_name, ops, raws)
+            return raws
+        tmp = tmp_name(dest1)
+        PDF2PNG[RASTERIZER](source, tmp)
+        commit_pngs(tmp, dest1)
     else:
+        WriteLockCacheEntry(base_name)
         png = ref+'.png'
         assert isfile(png), png
-        copy2(png, dest1)
+        tmp = tmp_name(dest1)
+        copy2(png, tmp)
+        replace(tmp, dest1)
     if blank:
         # Create a blank file
         logger.debug('Blanking '+dest1)
         blanked = base_name+'_blanked.png'
-        cmd = (CONVERT + ' "{}" -background white -threshold 100% -negate -colorspace Gray "{}"'.format(dest1, blanked))
+        tmp = tmp_name(blanked)
+        cmd = (CONVERT + ' "{}" -background white -threshold 100% -negate -colorspace Gray "{}"'.format(dest1, tmp))
         run_command(['bash', '-c', cmd])
+        replace(tmp, blanked)
         remove(dest1)
         dest1 = blanked
     if isfile(dest1):
-        return [dest1]
-    if isfile(destm):
-        return sorted(glob(base_name+'-*.png'))
-    assert False, f"Failed to convert {source} to PNG"
+        pngs = [dest1]
+    elif isfile(destm):
+        pngs = sorted(glob(splitext(dest1)[0]+'-*.png'))
+    else:
+        assert False, f"Failed to convert {source} to PNG"
+    ops = GetOptions(source) if not blank else None
+    if ops is not None:
+        if args.raster_format == 'raw':
+            pngs = [png2raw(png) for png in pngs]
+        SetPNGs(base_name, ops, pngs)
+    return pngs
+
+
+def store_raw_pages(base_name, source, pages):
+    """ Store the pages from an in-process rasterizer, so the next runs can reuse them """
+    ops = GetOptions(source)
+    if ops is None:
+        return
+    base = splitext(png_name(base_name))[0]
+    raws = []
+    for n, page in enumerate(pages):
+        raw = base+('-{}'.format(n) if len(pages) > 1 else '')+'.raw'
+        if args.mono:
+            write_raw(raw, page[0], page[1], 1)
+        else:
+            write_raw(raw, page, page.shape[1], 8)
+        raws.append(raw)
+    SetPNGs(base_name, ops, raws)
+
+
+def pdf2png_multi(hash_dir, layer_reps):
+    """ Convert many layers to PNG using only one pdftoppm run (or one for each job).
+        The PDFs are joined in one multi-page PDF, removed after the conversion. """
+    pending = []
+    for layer_rep in layer_reps:
+        pdf = hash_dir+sep+layer_rep+'.pdf'
+        if isfile(pdf) and GetPNGs(hash_dir+sep+layer_rep, pdf) is None:
+            pending.append(layer_rep)
+    if not pending:
+        return
+    WriteLockCacheEntry(hash_dir)
+    logger.info('Joining {} layers of {} in one PDF'.format(len(pending), hash_dir))
+    tmp = tmp_name(hash_dir+sep+'all_layers.pdf')
+    run_command(['pdfunite']+[hash_dir+sep+la+'.pdf' for la in pending]+[tmp])
+    if not isfile(tmp):
+        # pdf2png will convert each layer
+        logger.warning('Failed to join the layers')
+        return
+    # Split the pages in contiguous ranges, one for each job
+    pages = len(pending)
+    shards = min(args.jobs, pages)
+    prefix = tmp_name(hash_dir+sep+'all_layers-page')
+    cmds = []
+    for n in range(shards):
+        first = n*pages//shards+1
+        last = (n+1)*pages//shards
+        cmds.append(['pdftoppm', '-r', str(resolution)]+pdftoppm_crop() +
+                    [pdftoppm_mode(), '-png', '-f', str(first), '-l', str(last), tmp, prefix])
+    if shards > 1:
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            list(executor.map(run_command, cmds))
+    else:
+        run_command(cmds[0])
+    remove(tmp)
+    # pdftoppm uses a zero padded page number, the pages are in the `pending` order
+    for png in glob(prefix+'-*.png'):
+        page = int(splitext(png)[0][len(prefix)+1:])
+        base_name = hash_dir+sep+pending[page-1]
+        dest = png_name(base_name)
+        replace(png, dest)
+        if args.raster_format == 'raw':
+            dest = png2raw(dest)
+        ops = GetOptions(base_name+'.pdf')
+        if ops is not None:
+            SetPNGs(base_name, ops, [dest])
+
+
+def pdf2png_ready(base_name, layer):
+    pngs = pdf2png(base_name)
+    plot_ready(layer)
+    return pngs
+
+
+def queue_pdf2png(base_name, layer):
+    """ Convert a freshly plotted layer to PNG in background, so we can plot the next layer meanwhile.
+        Returns False if we don't convert it """
+    global raster_pool
+    if args.jobs < 2 or use_single_pdf or (in_worker and RASTERIZER in PDF2ARRAY):
+        # Note: in-process rasterizers doesn't create files, they aren't useful for a worker process
+        return False
+    if raster_pool is None:
+        raster_pool = ThreadPoolExecutor(max_workers=args.jobs)
+    logger.debug('Queuing {} for conversion to PNG'.format(base_name))
+    raster_jobs[base_name] = raster_pool.submit(pdf2png_ready, base_name, layer)
+    return True
+
+
+def wait_pdf2png(base_name):
+    """ Wait until the background conversion for this layer, if any, is finished """
+    job = raster_jobs.pop(base_name, None)
+    return job.result() if job is not None else None
+
+
+def get_pdf2png(base_name, blank, ref, reduce_from=None):
+    """ pdf2png, but using the background conversion when available """
+    if not blank:
+        res = wait_pdf2png(base_name)
+        if res is not None:
+            return res
+    return pdf2png(base_name, blank, ref, reduce_from)
+
+
+def wait_all_pdf2png():
+    for base_name in list(raster_jobs.keys()):
+        wait_pdf2png(base_name)
+
+
+def cancel_pdf2png():
+    """ Discard the pending conversions, they aren't needed (i.e. the other plot flavor) """
+    for job in raster_jobs.values():
+        job.cancel()
+    raster_jobs.clear()
 
 
 def create_no_diff(output_dir):
@@ -454,6 +1252,12 @@ def create_no_diff(output_dir):
     return diff_name
 
 
+def create_unchanged(diff_name, name_layer):
+    cmd = [CONVERT, '-size', '640x480', '-background', 'white', '-fill', 'black', '-pointsize', '48', '-gravity', 'center',
+           'label:'+name_layer+'\nunchanged', diff_name]
+    run_command(cmd)
+
+
 def adapt_name(name_layer):
     if name_layer.startswith(SCHEMATIC_SVG_BASE_NAME):
         rest = name_layer[len(SCHEMATIC_SVG_BASE_NAME):]
@@ -469,6 +1273,173 @@ def png_size(file):
     return int(w), int(h)
 
 
+def png_chunk(f, kind, data):
+    f.write(pack('>L', len(data))+kind)
+    f.write(data)
+    f.write(pack('>L', zlib.crc32(data, zlib.crc32(kind))))
+
+
+def png_open(name, width, height, color, bits=8, palette=None):
+    """ Start a PNG, the rows are added using png_write_rows. `color` is the PNG color type """
+    png = {'f': open(name, 'wb'), 'z': zlib.compressobj(6), 'prev': None}
+    png['f'].write(b'\x89PNG\r\n\x1a\n')
+    png_chunk(png['f'], b'IHDR', pack('>LLBBBBB', width, height, bits, color, 0, 0, 0))
+    if palette is not None:
+        png_chunk(png['f'], b'PLTE', np.array(palette, dtype=np.uint8).tobytes())
+    return png
+
+
+def png_write_rows(png, rows):
+    """ Add rows to the PNG, `rows` contains the bytes for each row. We use the `Up` filter """
+    prev = png['prev'] if png['prev'] is not None else np.zeros(rows.shape[1], dtype=np.uint8)
+    data = np.empty((rows.shape[0], rows.shape[1]+1), dtype=np.uint8)
+    data[:, 0] = 2
+    data[0, 1:] = rows[0]-prev
+    data[1:, 1:] = rows[1:]-rows[:-1]
+    png['prev'] = rows[-1].copy()
+    out = png['z'].compress(data.tobytes())
+    if out:
+        png_chunk(png['f'], b'IDAT', out)
+
+
+def png_close(png):
+    png_chunk(png['f'], b'IDAT', png['z'].flush())
+    png_chunk(png['f'], b'IEND', b'')
+    png['f'].close()
+
+
+def png_info(file):
+    """ Parse the PNG chunks. Returns the IHDR values, the resolution (DPIs), the palette and the IDAT chunks
+        (offset and size) """
+    info = {'dpi': 72, 'palette': None, 'idat': []}
+    with open(file, 'rb') as f:
+        if f.read(8) != b'\x89PNG\r\n\x1a\n':
+            return None
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                return None
+            size, kind = unpack('>L4s', head)
+            if kind == b'IDAT':
+                info['idat'].append((f.tell(), size))
+                f.seek(size+4, 1)
+                continue
+            data = f.read(size)
+            f.seek(4, 1)
+            if kind == b'IHDR':
+                info['w'], info['h'], info['depth'], info['color'], _, _, info['interlace'] = unpack('>LLBBBBB', data)
+            elif kind == b'PLTE':
+                info['palette'] = data
+            elif kind == b'pHYs':
+                x, y, unit = unpack('>LLB', data)
+                if unit == 1 and x:
+                    # Pixels per meter
+                    info['dpi'] = x*0.0254
+            elif kind == b'IEND':
+                return info
+
+
+def pdf_obj(pdf, num, data, stream_size=None):
+    """ Start an object, if `stream_size` is specified the caller must write the stream and call pdf_end_stream """
+    f = pdf['f']
+    pdf['offsets'][num] = f.tell()
+    f.write(b'%d 0 obj\n' % num+data)
+    if stream_size is None:
+        f.write(b'\nendobj\n')
+    else:
+        f.write(b'\nstream\n')
+
+
+def pdf_end_stream(pdf):
+    pdf['f'].write(b'\nendstream\nendobj\n')
+
+
+def pdf_update(pdf):
+    """ Write the pages tree and the cross reference for the objects added since the last update.
+        Each update is a PDF incremental update, so the file is a valid PDF after each page """
+    f = pdf['f']
+    kids = b' '.join(b'%d 0 R' % n for n in pdf['kids'])
+    pdf_obj(pdf, 2, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (kids, len(pdf['kids'])))
+    xref = f.tell()
+    f.write(b'xref\n')
+    nums = sorted(pdf['offsets'])
+    if pdf['prev'] is None:
+        # Head of the free objects list
+        nums.insert(0, 0)
+        pdf['offsets'][0] = None
+    while nums:
+        # Consecutive objects
+        count = 1
+        while count < len(nums) and nums[count] == nums[0]+count:
+            count += 1
+        f.write(b'%d %d\n' % (nums[0], count))
+        for n in nums[:count]:
+            offset = pdf['offsets'][n]
+            f.write(b'0000000000 65535 f \n' if offset is None else b'%010d 00000 n \n' % offset)
+        nums = nums[count:]
+    f.write(b'trailer\n<< /Size %d /Root 1 0 R' % pdf['next'])
+    if pdf['prev'] is not None:
+        f.write(b' /Prev %d' % pdf['prev'])
+    f.write(b' >>\nstartxref\n%d\n%%%%EOF\n' % xref)
+    f.flush()
+    pdf['prev'] = xref
+    pdf['offsets'] = {}
+
+
+def pdf_open(name):
+    """ Start a PDF, the pages are added using pdf_add_png """
+    pdf = {'f': open(name, 'wb'), 'name': name, 'offsets': {}, 'kids': [], 'next': 3, 'prev': None}
+    pdf['f'].write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+    pdf_obj(pdf, 1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    pdf_update(pdf)
+    return pdf
+
+
+def pdf_add_png(pdf, png):
+    """ Add a page containing a PNG. The compressed PNG data is copied to the PDF, no need to decode it """
+    info = png_info(png)
+    if info is None:
+        logger.error('Invalid PNG file: '+png)
+        exit(FAILED_TO_JOIN)
+    if info['color'] not in (0, 2, 3) or info['interlace']:
+        # Alpha channel or interlaced, the PDF can't use the data as is
+        tmp = tmp_name(png)
+        run_command([CONVERT, png, '-background', 'white', '-alpha', 'remove', '-alpha', 'off', '-interlace', 'none', tmp])
+        pdf_add_png(pdf, tmp)
+        remove(tmp)
+        return
+    if info['color'] == 3:
+        colors = 1
+        cs = b'[/Indexed /DeviceRGB %d <%s>]' % (len(info['palette'])//3-1, info['palette'].hex().encode())
+    else:
+        colors = 1 if info['color'] == 0 else 3
+        cs = b'/DeviceGray' if info['color'] == 0 else b'/DeviceRGB'
+    w = info['w']
+    h = info['h']
+    img = pdf['next']
+    pdf['next'] += 3
+    size = sum(s for _, s in info['idat'])
+    pdf_obj(pdf, img, b'<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent %d '
+            b'/Filter /FlateDecode /DecodeParms << /Predictor 15 /Colors %d /BitsPerComponent %d /Columns %d >> '
+            b'/Length %d >>' % (w, h, cs, info['depth'], colors, info['depth'], w, size), size)
+    with open(png, 'rb') as f:
+        for offset, s in info['idat']:
+            f.seek(offset)
+            pdf['f'].write(f.read(s))
+    pdf_end_stream(pdf)
+    # Page size in points
+    pw = w*72/info['dpi']
+    ph = h*72/info['dpi']
+    content = ('q {:.4f} 0 0 {:.4f} 0 0 cm /Im0 Do Q'.format(pw, ph)).encode()
+    pdf_obj(pdf, img+1, b'<< /Length %d >>' % len(content), len(content))
+    pdf['f'].write(content)
+    pdf_end_stream(pdf)
+    pdf_obj(pdf, img+2, ('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {:.4f} {:.4f}] /Resources << /XObject << /Im0 {} 0 R >> '
+                         '>> /Contents {} 0 R >>'.format(pw, ph, img, img+1)).encode())
+    pdf['kids'].append(img+2)
+    pdf_update(pdf)
+
+
 def create_diff_stereo(old_name, new_name, diff_name, font_size, layer, resolution, name_layer, only_different):
     wn, hn = png_size(new_name)
     wo, ho = png_size(old_name)
@@ -526,7 +1497,8 @@ def create_diff_stereo_colored(old_name, new_name, diff_name, font_size, layer,
     if only_different:
         res1 = run_command(['identify', '-format', '%k', added])
         res2 = run_command(['identify', '-format', '%k', removed])
-        include = res1 == '2' and res2 == '2'
+        # Any addition or removal, like the NumPy engine
+        include = res1 == '2' or res2 == '2'
     remove(added)
     remove(removed)
     return include
@@ -564,17 +1536,378 @@ def create_diff_stat(old_name, new_name, diff_name, font_size, layer, resolution
     return not only_different or (only_different and errors != 0)
 
 
-def DiffImages(old_file_hash, new_file_hash, layers_old, layers_new, only_different, changed):
+def np_load_gray(img):
+    """ Grayscale array for a PNG or raw raster, or the array from an in-process rasterizer """
+    if not isinstance(img, str):
+        return img
+    if img.endswith('.raw'):
+        a, w, bits = np_load_raw(img)
+        return a if bits == 8 else np.where(np.unpackbits(a, axis=1, count=w), 0, 255).astype(np.uint8)
+    return np.asarray(Image.open(img).convert('L'))
+
+
+def np_load_pair(old_name, new_name):
+    """ Load both images as grayscale arrays of the same size.
+        The smaller one is extended using a white background """
+    old = np_load_gray(old_name)
+    new = np_load_gray(new_name)
+    if old.shape == new.shape:
+        return old, new, ''
+    h = max(old.shape[0], new.shape[0])
+    w = max(old.shape[1], new.shape[1])
+    res = []
+    for img in (old, new):
+        a = np.full((h, w), 255, dtype=np.uint8)
+        a[:img.shape[0], :img.shape[1]] = img
+        res.append(a)
+    return res[0], res[1], ' [diff page size]'
+
+
+def np_font(font_size):
+    """ Font used for the labels, the same used by ImageMagick when possible """
+    if FONT_FILE:
+        try:
+            return ImageFont.truetype(FONT_FILE, font_size)
+        except OSError:
+            logger.debug('Failed to load font from `{}`'.format(FONT_FILE))
+    try:
+        return ImageFont.load_default(font_size)
+    except TypeError:
+        # Pillow < 10.1
+        return ImageFont.load_default()
+
+
+def np_palette(img):
+    """ Lossless palette version of an RGB image, None if it has more than 256 colors """
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    palette = np.array([c for _, c in colors], dtype=np.uint32)
+    keys = np.sort((palette[:, 0] << 16) | (palette[:, 1] << 8) | palette[:, 2])
+    # Look-up the colors in bands of rows, using one small buffer for the keys, so we don't create full size 32 bits
+    # copies of the page
+    a = np.asarray(img)
+    indexes = np.empty(a.shape[:2], dtype=np.uint8)
+    key = np.empty((min(PALETTE_BAND, a.shape[0]), a.shape[1]), dtype=np.uint32)
+    for y in range(0, a.shape[0], PALETTE_BAND):
+        band = a[y:y+PALETTE_BAND]
+        k = key[:band.shape[0]]
+        k[:] = band[..., 0]
+        k <<= 8
+        k |= band[..., 1]
+        k <<= 8
+        k |= band[..., 2]
+        indexes[y:y+PALETTE_BAND] = np.searchsorted(keys, k)
+    pal = Image.fromarray(indexes, 'P')
+    pal.putpalette(np.dstack((keys >> 16, (keys >> 8) & 0xFF, keys & 0xFF)).astype(np.uint8).tobytes())
+    # Use the smaller bit depth (i.e. 1 bit for a 2 colors page)
+    bits = next(b for b in (1, 2, 4, 8) if len(keys) <= 1 << b)
+    return pal, bits
+
+
+def np_save_diff(img, diff_name, font_size, label):
+    """ Draw the label and write the image. Images with few colors are stored using a palette """
+    img = Image.fromarray(img)
+    size = int(font_size)
+    ImageDraw.Draw(img).text((10, size), label, fill='black', font=np_font(size), anchor='ls')
+    pal = np_palette(img)
+    if pal is None:
+        img.save(diff_name)
+    else:
+        logger.debug('Using a {} bits palette for {}'.format(pal[1], diff_name))
+        pal[0].save(diff_name, bits=pal[1])
+
+
+def np_stereo(old, new):
+    """ The new image is used for the red channel, the old one for the green channel and the darker pixels of both
+        for the blue channel. Returns the image and the number of changes (0 or 1) """
+    return np.dstack((new, old, np.minimum(new, old))), int(not np.array_equal(old, new))
+
+
+def np_stereo_colored(old, new):
+    old_white = old > 127
+    new_white = new > 127
+    removed = new_white & ~old_white
+    added = old_white & ~new_white
+    img = np.dstack((old, old, old))
+    img[removed] = removed_rgb
+    img[added] = added_rgb
+    return img, int(removed.any() or added.any())
+
+
+def np_stat(old, new):
+    """ Mimics the `compare` output: the new image faded, different pixels highlighted in red.
+        Returns the image and the number of different pixels """
+    different = np.abs(new.astype(np.int16)-old) > args.fuzz*255/100
+    # ImageMagick default highlight (#f1001ecc) and lowlight (#ffffffcc) colors
+    color = np.where(different[..., None], np.array((241, 0, 30), dtype=np.float32), np.float32(255))
+    img = (new[..., None]*np.float32(0.2)+color*np.float32(0.8)).round().astype(np.uint8)
+    return img, int(np.count_nonzero(different))
+
+
+def check_stat_errors(errors, layer, name_layer):
+    logger.debug('AE for {}: {}'.format(layer, errors))
+    if args.threshold and errors > args.threshold:
+        logger.error('Difference for `{}` is not acceptable ({} > {})'.format(name_layer, errors, args.threshold))
+        exit(DIFF_TOO_BIG)
+
+
+def create_diff_stereo_np(old_name, new_name, diff_name, font_size, layer, resolution, name_layer, only_different):
+    """ NumPy version of create_diff_stereo """
+    old, new, extra_name = np_load_pair(old_name, new_name)
+    img, changes = np_stereo(old, new)
+    np_save_diff(img, diff_name, font_size, adapt_name(name_layer)+extra_name)
+    return not only_different or changes != 0
+
+
+def create_diff_stereo_colored_np(old_name, new_name, diff_name, font_size, layer, resolution, name_layer,
+                                  only_different):
+    """ NumPy version of create_diff_stereo_colored """
+    old, new, extra_name = np_load_pair(old_name, new_name)
+    img, changes = np_stereo_colored(old, new)
+    np_save_diff(img, diff_name, font_size, adapt_name(name_layer)+extra_name)
+    return not only_different or changes != 0
+
+
+def create_diff_stat_np(old_name, new_name, diff_name, font_size, layer, resolution, name_layer, only_different):
+    """ NumPy version of create_diff_stat """
+    old, new, extra_name = np_load_pair(old_name, new_name)
+    img, errors = np_stat(old, new)
+    check_stat_errors(errors, layer, name_layer)
+    np_save_diff(img, diff_name, font_size, adapt_name(name_layer)+extra_name)
+    return not only_different or (only_different and errors != 0)
+
+
+def np_pack(gray):
+    """ Bit-packed version of a grayscale image: 8 pixels for each byte, 1 is ink (dark).
+        Returns the packed rows and the width in pixels """
+    return np.packbits(gray < 128, axis=1), gray.shape[1]
+
+
+def pil_mono(img):
+    """ Black and white version of a Pillow image """
+    return img.convert('L').point(lambda v: 255 if v >= 128 else 0).convert('1')
+
+
+def np_load_packed(img):
+    """ Bit-packed image for a PNG or raw raster, or the packed array from an in-process rasterizer """
+    if not isinstance(img, str):
+        return img
+    if img.endswith('.raw'):
+        a, w, bits = np_load_raw(img)
+        return (a, w) if bits == 1 else np_pack(a)
+    with Image.open(img) as im:
+        if im.mode != '1':
+            im = pil_mono(im)
+        w, h = im.size
+        # PIL uses 1 for white, we use 1 for ink
+        packed = np.invert(np.frombuffer(im.tobytes(), dtype=np.uint8).reshape(h, (w+7)//8))
+    if w % 8:
+        # Clear the padding
+        packed[:, -1] &= np.uint8((0xFF << (8-w % 8)) & 0xFF)
+    return packed, w
+
+
+def np_load_packed_pair(old_name, new_name):
+    """ Load both images bit-packed, using the same size. The smaller one is extended using a white background """
+    old, old_w = np_load_packed(old_name)
+    new, new_w = np_load_packed(new_name)
+    if old.shape == new.shape and old_w == new_w:
+        return old, new, old_w, ''
+    h = max(old.shape[0], new.shape[0])
+    w = max(old.shape[1], new.shape[1])
+    res = []
+    for img in (old, new):
+        a = np.zeros((h, w), dtype=np.uint8)
+        a[:img.shape[0], :img.shape[1]] = img
+        res.append(a)
+    return res[0], res[1], max(old_w, new_w), ' [diff page size]'
+
+
+def np_popcount(packed):
+    """ Number of 1 bits """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(packed).sum(dtype=np.uint64))
+    bits = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+    return int(bits[packed].sum(dtype=np.uint64))
+
+
+def np_spread(bits):
+    """ Table to move each bit of a byte to the lowest bit of a `bits` bits field, the first pixel in the MSBs """
+    n = np.arange(256, dtype=np.uint64)
+    table = np.zeros(256, dtype=np.uint64)
+    for i in range(8):
+        table |= ((n >> np.uint64(i)) & np.uint64(1)) << np.uint64(i*bits)
+    return table.astype('u{}'.format(bits))
+
+
+def np_packed_index(a, b, w, bits):
+    """ PNG rows for the palette indexes of two bit-packed images: b*2+a, using `bits` bits for each index.
+        Computed from the packed bytes, 8 pixels at a time, the images aren't unpacked """
+    table = np_spread(bits)
+    rows = ((table[b] << 1) | table[a]).astype('>u{}'.format(bits))
+    return rows.view(np.uint8).reshape(a.shape[0], -1)[:, :(w*bits+7)//8]
+
+
+def np_packed_label(rows, w, bits, palette, label, size):
+    """ Draw the label on PNG rows with `bits` bits palette indexes. Only the rows for the label are unpacked """
+    n = min(rows.shape[0], 2*size)
+    raw_mode = 'P;{}'.format(bits) if bits < 8 else 'P'
+    img = Image.frombytes('P', (w, n), np.ascontiguousarray(rows[:n]).tobytes(), 'raw', raw_mode)
+    # No antialiasing for palette images, the label doesn't add colors
+    ImageDraw.Draw(img).text((10, size), label, fill=palette.index((0, 0, 0)), font=np_font(size), anchor='ls')
+    rows[:n] = np.frombuffer(img.tobytes('raw', raw_mode), dtype=np.uint8).reshape(n, -1)
+
+
+def mono_palette():
+    """ Colors for the bit-packed diffs, plus black for the label """
+    if args.diff_mode == 'red_green':
+        # white, only in old (red), only in new (green), both (black)
+        palette = [(255, 255, 255), (255, 0, 0), (0, 255, 0), (0, 0, 0)]
+    elif args.diff_mode == '2color':
+        palette = [(255, 255, 255), removed_rgb, added_rgb,
+                   (0, 0, 0)]
+    else:
+        # Same colors used by np_stat, indexed by different*2+ink
+        palette = [tuple(round(g*0.2+c*0.8) for c in color) for color in ((255, 255, 255), (241, 0, 30)) for g in (255, 0)]
+    if (0, 0, 0) not in palette:
+        palette.append((0, 0, 0))
+    return palette
+
+
+def np_mono(old, new, w, bits):
+    """ PNG rows for the bit-packed diffs, and the number of changes (see np_stereo and np_stat).
+        The changes are computed using the packed bytes """
+    different = old ^ new
+    if args.diff_mode == 'stats':
+        return np_packed_index(new, different, w, bits), np_popcount(different)
+    # Removed is old & ~new, added is new & ~old, any of them is a change
+    return np_packed_index(old, new, w, bits), int(different.any())
+
+
+def palette_bits(palette):
+    """ Smaller PNG bit depth for the palette """
+    return next(b for b in (1, 2, 4, 8) if len(palette) <= 1 << b)
+
+
+def create_diff_mono(old_name, new_name, diff_name, font_size, layer, resolution, name_layer, only_different):
+    """ NumPy diffs for bit-packed images, for all the modes. The fuzz isn't used.
+        The images are never unpacked, the PNG rows are computed from the packed bytes (see mono_palette) """
+    old, new, w, extra_name = np_load_packed_pair(old_name, new_name)
+    palette = mono_palette()
+    bits = palette_bits(palette)
+    rows, changes = np_mono(old, new, w, bits)
+    if args.diff_mode == 'stats':
+        check_stat_errors(changes, layer, name_layer)
+    np_packed_label(rows, w, bits, palette, adapt_name(name_layer)+extra_name, int(font_size))
+    png = png_open(diff_name, w, rows.shape[0], 3, bits, palette)
+    png_write_rows(png, rows)
+    png_close(png)
+    return not only_different or changes != 0
+
+
+def np_band(img, y0, y1, cols, fill):
+    """ Rows y0 to y1 of an image, using `cols` columns. Missing rows and columns are filled using `fill` """
+    part = img[y0:y1, :cols]
+    if part.shape == (y1-y0, cols):
+        return np.asarray(part)
+    band = np.full((y1-y0, cols), fill, dtype=np.uint8)
+    band[:part.shape[0], :part.shape[1]] = part
+    return band
+
+
+def create_diff_banded(old_name, new_name, diff_name, font_size, layer, resolution, name_layer, only_different):
+    """ NumPy diffs computed in horizontal bands of --band_height rows, the PNG is written band by band.
+        The raw bitmaps are memory mapped, so the memory used doesn't depend on the page size """
+    mono = args.mono
+    if mono:
+        old, old_w = np_load_packed(old_name)
+        new, new_w = np_load_packed(new_name)
+        fill = 0
+    else:
+        old = np_load_gray(old_name)
+        new = np_load_gray(new_name)
+        old_w = old.shape[1]
+        new_w = new.shape[1]
+        fill = 255
+    w = max(old_w, new_w)
+    h = max(old.shape[0], new.shape[0])
+    cols = max(old.shape[1], new.shape[1])
+    extra_name = '' if old.shape == new.shape and old_w == new_w else ' [diff page size]'
+    size = int(font_size)
+    if mono:
+        palette = mono_palette()
+        bits = palette_bits(palette)
+        png = png_open(diff_name, w, h, 3, bits, palette)
+    else:
+        png = png_open(diff_name, w, h, 2)
+        create_band = {'red_green': np_stereo, '2color': np_stereo_colored, 'stats': np_stat}[args.diff_mode]
+    label = adapt_name(name_layer)+extra_name
+    changes = 0
+    y0 = 0
+    while y0 < h:
+        # The first band must contain the label
+        y1 = min(h, y0+(args.band_height if y0 else max(args.band_height, 2*size)))
+        old_band = np_band(old, y0, y1, cols, fill)
+        new_band = np_band(new, y0, y1, cols, fill)
+        if mono:
+            img, c = np_mono(old_band, new_band, w, bits)
+            if not y0:
+                np_packed_label(img, w, bits, palette, label, size)
+        else:
+            img, c = create_band(old_band, new_band)
+            if not y0:
+                img = Image.fromarray(img, 'RGB')
+                ImageDraw.Draw(img).text((10, size), label, fill='black', font=np_font(size), anchor='ls')
+                img = np.asarray(img)
+            img = img.reshape(img.shape[0], -1)
+        changes += c
+        png_write_rows(png, img)
+        y0 = y1
+    png_close(png)
+    if args.diff_mode == 'stats':
+        check_stat_errors(changes, layer, name_layer)
+    return not only_different or changes != 0
+
+
+def DiffImages(old_file_hash, new_file_hash, layers_old, layers_new, only_different, changed, wait_layer=None):
+    """ Compute the diff for each layer and join them in the output PDF.
+        `wait_layer` is used when the layers are still being plotted (see GenImagesParallel) """
     old_hash_dir = cache_dir+sep+old_file_hash
     new_hash_dir = cache_dir+sep+new_file_hash
-    files = [CONVERT]
+    files = []
     # Compute the difference between images for each layer, store JPGs
     font_size = str(int(resolution/5))
     all_layers = {}
     all_layers.update(layers_old)
     all_layers.update(layers_new)
     skipped = []
-    for i in sorted(all_layers.keys()):
+    if args.diff_mode == 'red_green':
+        create_diff = create_diff_stereo_np if use_numpy else create_diff_stereo
+    elif args.diff_mode == '2color':
+        create_diff = create_diff_stereo_colored_np if use_numpy else create_diff_stereo_colored
+    else:
+        create_diff = create_diff_stat_np if use_numpy else create_diff_stat
+    if use_numpy and args.mono:
+        create_diff = create_diff_mono
+    if use_numpy and args.band_height:
+        create_diff = create_diff_banded
+
+    unchanged = set()
+    if unchanged_layers:
+        unchanged = {r[0] for r in CacheGetValue(new_hash_dir, 'layers') or [] if r[1] in unchanged_layers}
+
+    if use_single_pdf and is_pcb:
+        if wait_layer is not None:
+            wait_layer(0)
+            wait_layer(1)
+        sc_id = '_1' if changed else ''
+        pdf2png_multi(old_hash_dir, [str(i)+sc_id for i in layers_old if i not in unchanged])
+        if new_hash_dir != old_hash_dir:
+            pdf2png_multi(new_hash_dir, [str(i)+sc_id for i in layers_new if i not in unchanged])
+
+    def diff_layer(i):
+        """ Rasterize both versions of a layer and compute the diff """
         if svg_mode:
             # Multisheet schematic
             layer_rep = layer = i
@@ -589,11 +1922,23 @@ def DiffImages(old_file_hash, new_file_hash, layers_old, layers_new, only_differ
         else:  # Normal schematic (single or no rsvg-convert)
             layer_rep = layer = all_layers[i]
             name_layer = layer
+        if i in unchanged:
+            diff_name = output_dir+sep+'diff-'+layer_rep+'0.png'
+            logger.info('Layer {} is unchanged'.format(layer))
+            create_unchanged(diff_name, name_layer)
+            return [(diff_name, not only_different)]
+        if wait_layer is not None:
+            # Start as soon as both sides are ready
+            if i in layers_old:
+                wait_layer(0, i)
+            if i in layers_new:
+                wait_layer(1, i)
         # Convert the PDFs to PNGs
         old_file = old_hash_dir+sep+layer_rep
         new_file = new_hash_dir+sep+layer_rep
-        old = pdf2png(old_file, i not in layers_old, new_file)
-        new = pdf2png(new_file, i not in layers_new, old_file)
+        reduce_from = pair_reduce_from(old_file, new_file) if i in layers_old and i in layers_new else None
+        old = get_pdf2png(old_file, i not in layers_old, new_file, reduce_from)
+        new = get_pdf2png(new_file, i not in layers_new, old_file, reduce_from)
         if i not in layers_old:
             name_layer += ' only in new file'
         if i not in layers_new:
@@ -601,69 +1946,194 @@ def DiffImages(old_file_hash, new_file_hash, layers_old, layers_new, only_differ
         if len(old) != len(new):
             logger.error("Adding/removing sheets isn't supported without `rsvg-convert`")
             exit(FAILED_TO_DIFF)
+        res = []
         for i, old_name in enumerate(old):
             new_name = new[i]
             diff_name = output_dir+sep+'diff-'+layer_rep+str(i)+'.png'
             logger.info('Creating diff for '+(layer+'_'+str(i) if len(old) > 1 else layer))
-            if args.diff_mode == 'red_green':
-                inc = create_diff_stereo(old_name, new_name, diff_name, font_size, layer, resolution, name_layer,
-                                         only_different)
-            elif args.diff_mode == '2color':
-                inc = create_diff_stereo_colored(old_name, new_name, diff_name, font_size, layer, resolution,
-                                                 name_layer, only_different)
-            else:
-                inc = create_diff_stat(old_name, new_name, diff_name, font_size, layer, resolution, name_layer,
-                                       only_different)
+            inc = create_diff(old_name, new_name, diff_name, font_size, layer, resolution, name_layer, only_different)
             if not isfile(diff_name):
                 logger.error('Failed to create diff %s' % diff_name)
                 exit(FAILED_TO_DIFF)
-            if inc:
-                files.append(diff_name)
-            else:
-                skipped.append(diff_name)
+            res.append((diff_name, inc))
+        return res
+
+    def add_diffs(results):
+        """ Add the diffs to the PDF as soon as they are available """
+        for res in results:
+            for diff_name, inc in res:
+                if inc:
+                    AddDiff(pdf, diff_name)
+                    files.append(diff_name)
+                else:
+                    skipped.append(diff_name)
+
+    layers = sorted(all_layers.keys())
+    pdf = OpenDiffs()
+    if args.jobs > 1:
+        # The layers are independent, the executor keeps the original order
+        logger.debug('Computing the diffs using {} jobs'.format(args.jobs))
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            add_diffs(executor.map(diff_layer, layers))
+        cancel_pdf2png()
+    else:
+        add_diffs(map(diff_layer, layers))
     # Check if we skipped all
-    if len(files) == 1 and skipped:
+    if not files and skipped:
         files.append(create_no_diff(output_dir))
-    # Join all the JPGs into one PDF
-    out_name = output_dir+sep+args.output_name
-    output_pdf = out_name
+        AddDiff(pdf, files[0])
+    return CloseDiffs(pdf, files, skipped)
+
+
+def OpenDiffs():
+    """ Start the output PDF, the diffs are added as soon as they are computed """
+    output_pdf = output_dir+sep+args.output_name
     # The name must end with .pdf
     if not output_pdf.endswith('.pdf'):
         output_pdf += '.pdf'
-    files.append(output_pdf)
-    if len(files) > 2:
-        logger.info('Joining all diffs into one PDF')
-        logger.debug(files)
-        call(files)
-    else:
+    try:
+        return pdf_open(output_pdf)
+    except OSError as e:
+        logger.error('Failed to create {}: {}'.format(output_pdf, e))
+        exit(FAILED_TO_JOIN)
+
+
+def AddDiff(pdf, diff_name):
+    logger.debug('Adding {} to {}'.format(diff_name, pdf['name']))
+    pdf_add_png(pdf, diff_name)
+
+
+def CloseDiffs(pdf, files, skipped):
+    """ Finish the output PDF. `files` are the diffs added to it """
+    pdf['f'].close()
+    output_pdf = pdf['name']
+    if not files:
+        remove(output_pdf)
         logger.error('Nothing to compare!')
         exit(NOTHING_TO_COMPARE)
-
-    if not isfile(output_pdf):
-        logger.error('Failed to join diffs into %s' % output_pdf)
-        exit(FAILED_TO_JOIN)
     # Fix the name
-    if not args.output_name.endswith('.pdf'):
+    out_name = output_dir+sep+args.output_name
+    if output_pdf != out_name:
         logger.debug('{} -> {}'.format(output_pdf, out_name))
         rename(output_pdf, out_name)
     # Remove the individual PNGs
     if not args.keep_pngs:
-        for f in files[1:-1]+skipped:
+        for f in files+skipped:
             remove(f)
     return out_name
 
 
+def JoinDiffs(files, skipped):
+    """ Join all the diffs into one PDF """
+    pdf = OpenDiffs()
+    for f in files:
+        AddDiff(pdf, f)
+    return CloseDiffs(pdf, files, skipped)
+
+
+def PlotAndDiff(old_file, old_file_hash, new_file, new_file_hash):
+    """ Plot both files, or use the cached plots, and compute the diffs. Returns the output PDF """
+    global unchanged_layers
+    if old_file_hash == new_file_hash and args.only_different and not args.kiri_mode:
+        logger.info('Both files have the same contents')
+        return JoinDiffs([create_no_diff(output_dir)], [])
+    unchanged_layers = UnchangedLayers(old_file, old_file_hash, new_file, new_file_hash)
+    LockCacheEntries(old_file_hash, new_file_hash)
+    wait_layer = None
+    if args.jobs > 1 and is_pcb and old_file_hash != new_file_hash:
+        # Plot both PCBs at the same time, the diffs start as soon as both sides of a layer are ready
+        layers_old, layers_new, changed, wait_layer = GenImagesParallel(
+            (old_file, old_file_hash, args.all_pages, args.zones, args.kiri_mode),
+            (new_file, new_file_hash, args.all_pages, args.zones, False))
+    else:
+        # For PCBs we first compare the bounding boxes, so we know which flavor is needed
+        changed = is_pcb and SelectFlavor(GetBBox(old_file, old_file_hash), GetBBox(new_file, new_file_hash))
+        layers_old, _ = GenImages(old_file, old_file_hash, args.all_pages, args.zones, args.kiri_mode, not changed)
+        layers_new, _ = GenImages(new_file, new_file_hash, args.all_pages, args.zones, scaled=not changed)
+
+    output_pdf = DiffImages(old_file_hash, new_file_hash, layers_old, layers_new, args.only_different, changed,
+                            wait_layer)
+    if wait_layer is not None:
+        # The children could fail after plotting the last layer
+        wait_layer(0)
+        wait_layer(1)
+    UnlockCacheEntries()
+    return output_pdf
+
+
 def GetDigest(file_path):
     h = sha1()
-    with open(file_path, 'rb') as file:
+    buf = bytearray(DIGEST_BUFFER)
+    view = memoryview(buf)
+    with open(file_path, 'rb', buffering=0) as file:
         while True:
-            chunk = file.read(h.block_size)
-            if not chunk:
+            n = file.readinto(buf)
+            if not n:
                 break
-            h.update(chunk)
+            h.update(view[:n])
     return h.hexdigest()
 
 
+def write_sexp(h, item):
+    """ Feed a normalized version of the S-Expression to the hash.
+        The volatile data is skipped and the properties are sorted. """
+    if isinstance(item, str):
+        h.update(b'"'+item.encode()+b'"')
+        return
+    h.update(b'(')
+    props = []
+    for c in item[2]:
+        head = sexp_head(c)
+        if head in SEXP_VOLATILE:
+            continue
+        if head == 'property':
+            props.append(sexp_digest(c))
+        else:
+            write_sexp(h, c)
+    for p in sorted(props):
+        h.update(p)
+    h.update(b')')
+
+
+def sexp_digest(item):
+    h = sha1()
+    write_sexp(h, item)
+    return h.digest()
+
+
+def NormalizedDigest(file_path):
+    """ SHA1 of the file contents, ignoring changes that doesn't affect the plots.
+        I.e. time stamps, UUIDs, order of the properties and white spaces. """
+    with open(file_path, 'rt') as f:
+        text = f.read()
+    if not text.lstrip().startswith('('):
+        # Not an S-Expression (KiCad 5 schematic)
+        return GetDigest(file_path)
+    h = sha1()
+    write_sexp(h, parse_sexp(text))
+    return h.hexdigest()
+
+
+def FileDigest(file_path):
+    """ Hash used for the cache entry of a file.
+        Memoized in the cache index, the file is hashed again only if its size, mtime or inode changed """
+    normalized = int(args.normalized_hash)
+    path = realpath(file_path)
+    st = stat(path)
+    key = (st.st_size, st.st_mtime_ns, st.st_ino)
+    db = CacheDB()
+    row = db.execute('SELECT size, mtime_ns, inode, digest FROM digests WHERE path=? AND normalized=?',
+                     (path, normalized)).fetchone()
+    if row is not None and tuple(row[:3]) == key:
+        logger.debug('Using the memoized digest for '+file_path)
+        return row[3]
+    digest = NormalizedDigest(file_path) if normalized else GetDigest(file_path)
+    # A file modified a moment ago can be modified again without changing its mtime
+    if time.time()*1e9-st.st_mtime_ns > 2e9:
+        db.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)', (path, normalized)+key+(digest,))
+    return digest
+
+
 def CleanOutputDir():
     rmtree(output_dir)
 
@@ -672,6 +2142,208 @@ def CleanCacheDir():
     rmtree(cache_dir)
 
 
+def tmp_name(name):
+    """ Temporal name used to create `name`, the file is renamed when complete.
+        So other processes sharing the cache never see partial files """
+    return '{}{}.tmp{}_{}_{}'.format(dirname(name), sep, getpid(), get_ident(), basename(name))
+
+
+@contextmanager
+def atomic_open(name, mode='wt'):
+    """ Like open(), but the file gets its name only after closing it """
+    tmp = tmp_name(name)
+    with open(tmp, mode) as f:
+        yield f
+    replace(tmp, name)
+
+
+def TryLockCacheEntry(hash_dir, wait, shared=False, f=None):
+    """ Lock a cache entry, exclusive unless `shared`. Returns the locked file, or None if busy (and not `wait`).
+        `f` is the lock file, when we are changing the mode of a lock """
+    lock_name = hash_dir+sep+'.lock'
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    while True:
+        if f is None:
+            makedirs(hash_dir, exist_ok=True)
+            f = open(lock_name, 'a')
+        try:
+            fcntl.flock(f, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                f.close()
+                return None
+            logger.info('Waiting for another process using `{}`'.format(hash_dir))
+            fcntl.flock(f, mode)
+        # The entry could be removed (GC) while we were waiting
+        if isfile(lock_name) and stat(lock_name).st_ino == fstat(f.fileno()).st_ino:
+            return f
+        f.close()
+        f = None
+
+
+def tmp_leftover(name):
+    """ The process creating this temporal file doesn't exist anymore (see tmp_name) """
+    try:
+        kill(int(basename(name)[4:].split('_', 1)[0]), 0)
+    except (ValueError, ProcessLookupError):
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def LockCacheEntry(hash_dir):
+    """ Lock a cache entry until UnlockCacheEntries is called.
+        The entry is shared with other runs, we get exclusive access only to create files (see WriteLockCacheEntry).
+        The `.complete` marker is removed while we write to the entry, if we find the entry without it the last
+        writer didn't finish and we remove its leftovers. """
+    if hash_dir in cache_locks:
+        return
+    f = TryLockCacheEntry(hash_dir, True, shared=True)
+    cache_locks[hash_dir] = [f, False]
+    complete = hash_dir+sep+'.complete'
+    if isfile(complete):
+        return
+    # New entry, or the last writer didn't finish.
+    # We lock the entries in order, so we can wait while holding the previous entries.
+    cache_locks[hash_dir] = [TryLockCacheEntry(hash_dir, True, f=f), True]
+    if isfile(complete):
+        # Another run completed it while we were waiting
+        cache_locks[hash_dir] = [TryLockCacheEntry(hash_dir, True, shared=True, f=cache_locks[hash_dir][0]), False]
+        return
+    for f in glob(hash_dir+sep+'**'+sep+'.tmp*', recursive=True):
+        if tmp_leftover(f):
+            logger.debug('Removing leftover '+f)
+            remove(f)
+
+
+def LockCacheEntries(*hashes):
+    # Always in the same order, to avoid dead locks
+    for file_hash in sorted(set(hashes)):
+        LockCacheEntry(cache_dir+sep+file_hash)
+
+
+def WriteLockCacheEntry(name):
+    """ Get exclusive access to the locked cache entry containing `name`, we are going to create files in it.
+        Kept until UnlockCacheEntries.
+        Converting a lock isn't atomic, if another run got the entry we can't wait holding the rest of the entries,
+        it could be waiting for them. So we release all the entries and lock them again in order. """
+    hash_dir = cache_dir+sep+CacheKey(name)[0]
+    entry = cache_locks.get(hash_dir)
+    if entry is None or entry[1]:
+        return
+    with cache_locks_lock:
+        if cache_locks[hash_dir][1]:
+            # Another thread did it
+            return
+        try:
+            fcntl.flock(cache_locks[hash_dir][0], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            cache_locks[hash_dir][1] = True
+        except BlockingIOError:
+            # The lock files are shared with the worker processes, so we use the same files
+            for f, _ in cache_locks.values():
+                fcntl.flock(f, fcntl.LOCK_UN)
+            for name in sorted(cache_locks):
+                f, exclusive = cache_locks[name]
+                exclusive = exclusive or name == hash_dir
+                cache_locks[name] = [TryLockCacheEntry(name, True, not exclusive, f), exclusive]
+        complete = hash_dir+sep+'.complete'
+        if isfile(complete):
+            remove(complete)
+
+
+def UnlockCacheEntries():
+    for hash_dir, (f, _) in cache_locks.items():
+        # Note: a worker process could create files in the entry, so we look for the marker
+        if not isfile(hash_dir+sep+'.complete'):
+            with open(hash_dir+sep+'.complete', 'w'):
+                pass
+            # Measured only here, so CacheGC doesn't need to walk the whole cache
+            CacheDB().execute('UPDATE entries SET size=? WHERE hash=?', (CacheEntrySize(hash_dir), basename(hash_dir)))
+        f.close()
+    cache_locks.clear()
+
+
+def TouchCacheEntry(hash_dir):
+    """ Mark a cache entry as used now, used to remove the least recently used entries """
+    makedirs(hash_dir, exist_ok=True)
+    db = CacheDB()
+    file_hash = basename(hash_dir)
+    now = time.time()
+    # Keep the size, computed when the entry was completed
+    db.execute('UPDATE entries SET last_used=? WHERE hash=?', (now, file_hash))
+    db.execute('INSERT OR IGNORE INTO entries (hash, last_used) VALUES (?, ?)', (file_hash, now))
+
+
+def CacheEntrySize(hash_dir):
+    size = 0
+    for root, _, files in walk(hash_dir):
+        for f in files:
+            try:
+                size += getsize(join(root, f))
+            except OSError:
+                pass
+    return size
+
+
+def CacheGCOnly():
+    """ Implements --cache_gc """
+    global cache_dir
+    if not args.cache_dir or not isdir(args.cache_dir):
+        logger.error('Asking to clean the cache, but no valid cache dir specified')
+        exit(ARGS_ERROR)
+    if not args.cache_max_size and not args.cache_max_age:
+        logger.warning('No cache limits specified, use --cache_max_size and/or --cache_max_age')
+    cache_dir = args.cache_dir
+    CacheGC([])
+    exit(0)
+
+
+def CacheGC(protected):
+    """ Remove the least recently used cache entries, until the cache meets the size and age limits.
+        The entries in `protected` are never removed """
+    if not args.cache_dir or (not args.cache_max_size and not args.cache_max_age):
+        return
+    # Forget the digests for files that doesn't exist anymore
+    db = CacheDB()
+    for path, in db.execute('SELECT DISTINCT path FROM digests').fetchall():
+        if not isfile(path):
+            db.execute('DELETE FROM digests WHERE path=?', (path,))
+    indexed = {h: (last_used, size) for h, last_used, size in db.execute('SELECT hash, last_used, size FROM entries')}
+    entries = []
+    for name in listdir(cache_dir):
+        hash_dir = cache_dir+sep+name
+        if name[0] != '.' and isdir(hash_dir):
+            last_used, size = indexed.get(name, (None, None))
+            if last_used is None:
+                last_used = getmtime(hash_dir)
+            if size is None:
+                # Not completed yet, or left by an interrupted run
+                size = CacheEntrySize(hash_dir)
+            entries.append((last_used, size, name))
+    total = sum(e[1] for e in entries)
+    logger.debug('Cache size: {} bytes in {} entries'.format(total, len(entries)))
+    max_size = args.cache_max_size*1024*1024 if args.cache_max_size else None
+    min_time = time.time()-args.cache_max_age*86400 if args.cache_max_age else None
+    # Oldest first
+    for last_used, size, name in sorted(entries):
+        too_old = min_time is not None and last_used < min_time
+        too_big = max_size is not None and total > max_size
+        if not too_old and not too_big:
+            break
+        if name in protected:
+            continue
+        lock = TryLockCacheEntry(cache_dir+sep+name, False)
+        if lock is None:
+            logger.debug('`{}` is in use, not removed'.format(name))
+            continue
+        logger.info('Removing `{}` from the cache ({} bytes)'.format(name, size))
+        rmtree(cache_dir+sep+name, ignore_errors=True)
+        CacheRemoveEntry(name)
+        lock.close()
+        total -= size
+
+
 def id2def_name(id):
     id = int(id)
     if hasattr(pcbnew, 'LayerName'):
@@ -679,42 +2351,31 @@ def id2def_name(id):
     return DEFAULT_LAYER_NAMES[id]
 
 
-def load_cached_layers(layers_file):
+def load_cached_layers(all_layers):
     layer_names = {}
     name_to_id = {}
-    logger.debug('Loading layers from cache '+layers_file)
-    with open(layers_file) as csvfile:
-        reader = csv.reader(csvfile)
-        header = next(reader)
-        logger.debug(header)
-        for r in reader:
-            ilnum = int(r[0])
-            lname = r[1]
-            lname_user = r[2]
-            name_to_id[lname] = ilnum
-            logger.debug(lname+'->'+str(ilnum))
-            if lname_user:
-                name_to_id[lname_user] = ilnum
-            # Is in the in/exclude list?
-            if (lname in layer_list or lname_user in layer_list or ilnum in layer_list) ^ is_exclude:
-                layer_names[ilnum] = lname
-            else:
-                logger.debug('Excluding layer '+lname)
+    logger.debug('Loading layers from cache')
+    for ilnum, lname, lname_user in all_layers:
+        name_to_id[lname] = ilnum
+        logger.debug(lname+'->'+str(ilnum))
+        if lname_user:
+            name_to_id[lname_user] = ilnum
+        # Is in the in/exclude list?
+        if (lname in layer_list or lname_user in layer_list or ilnum in layer_list) ^ is_exclude:
+            layer_names[ilnum] = lname
+        else:
+            logger.debug('Excluding layer '+lname)
     return layer_names, name_to_id
 
 
-def save_layers_to_cache(layers_file, all_layers, kiri_mode):
-    dname = dirname(layers_file)
-    makedirs(dname, exist_ok=True)
+def save_layers_to_cache(hash_dir, all_layers, kiri_mode):
+    makedirs(hash_dir, exist_ok=True)
     if kiri_mode:
         return
-    with open(layers_file, 'wt') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(('Layer ID', 'Layer name', 'User name'))
-        writer.writerows(all_layers)
+    CacheSetValue(hash_dir, 'layers', all_layers)
 
 
-def load_layers_from_pcb(pcb_file, layers_file, kiri_mode):
+def load_layers_from_pcb(pcb_file, hash_dir, kiri_mode):
     # We get the layers from the PCB because BOARD.GetLayerName(id) and BOARD.GetStandardLayerName(id) returns the same
     # even for files using the KiCad 5 names as user names
     layer_names = {}
@@ -769,17 +2430,17 @@ def load_layers_from_pcb(pcb_file, layers_file, kiri_mode):
                         convert_layers = version < 20241228 and kicad_version_major >= 9
                 if re.search(r'\s+\(layers', line):
                     collect_layers = True
-    save_layers_to_cache(layers_file, all_layers, kiri_mode)
+    save_layers_to_cache(hash_dir, all_layers, kiri_mode)
     return layer_names, name_to_id
 
 
 def load_layer_names(pcb_file, hash_dir, kiri_mode):
     # Check if this is cached
-    layers_file = hash_dir+sep+'layers.csv'
-    if isfile(layers_file):
-        layer_names, name_to_id = load_cached_layers(layers_file)
+    all_layers = CacheGetValue(hash_dir, 'layers')
+    if all_layers is not None:
+        layer_names, name_to_id = load_cached_layers(all_layers)
     else:
-        layer_names, name_to_id = load_layers_from_pcb(pcb_file, layers_file, kiri_mode)
+        layer_names, name_to_id = load_layers_from_pcb(pcb_file, hash_dir, kiri_mode)
     if layer_list and not is_exclude:
         wanted_layers = {}
         for la in layer_list:
@@ -794,6 +2455,129 @@ def load_layer_names(pcb_file, hash_dir, kiri_mode):
     return layer_names, layer_names
 
 
+def parse_sexp(text):
+    """ Simple S-Expression parser.
+        Lists are returned as [start, end, items], where start and end are the offsets in `text` """
+    stack = [[0, len(text), []]]
+    for m in SEXP_TOKENS.finditer(text):
+        tok = m.group()
+        if tok == '(':
+            stack.append([m.start(), None, []])
+        elif tok == ')':
+            cur = stack.pop()
+            cur[1] = m.end()
+            stack[-1][2].append(cur)
+        else:
+            stack[-1][2].append(tok[1:-1] if tok[0] == '"' else tok)
+    return stack[0][2][0]
+
+
+def sexp_head(item):
+    return item[2][0] if isinstance(item, list) and item[2] and isinstance(item[2][0], str) else None
+
+
+def sexp_layers(item):
+    """ Layers specified by the (layer X) or (layers X Y ...) children """
+    for c in item[2]:
+        head = sexp_head(c)
+        if head == 'layer':
+            return c[2][1:2]
+        if head == 'layers':
+            return [la for la in c[2][1:] if isinstance(la, str)]
+    return None
+
+
+def expand_layers(layers, names):
+    """ Solve the layer wildcards (*.Cu, F&B.Cu) """
+    res = set()
+    for la in layers:
+        if la.startswith('*'):
+            res.update(n for n in names if n.endswith(la[1:]))
+        elif la.startswith('F&B.'):
+            res.update(('F'+la[3:], 'B'+la[3:]))
+        else:
+            res.add(la)
+    return res
+
+
+def layer_digests(pcb_file):
+    """ Compute a digest for each layer of the PCB, using the normalized items (see write_sexp).
+        Each digest covers the items on the layer, including the footprint items (and the footprint data) and the
+        items spanning it (vias, pads, zones). Items without layer (page, setup, etc.) and the Edge.Cuts items are
+        plotted in all the layers, so they are part of all the digests. """
+    with open(pcb_file, 'rt') as f:
+        text = f.read()
+    pcb = parse_sexp(text)
+    names = []
+    for c in pcb[2]:
+        if sexp_head(c) == 'layers':
+            names = [la[2][1] for la in c[2][1:] if isinstance(la, list) and len(la[2]) > 1]
+    copper_and_mask = expand_layers(('*.Cu', '*.Mask'), names)
+    per_layer = {n: sha1() for n in names}
+    common = sha1()
+
+    def add(item, layers, context=b''):
+        data = context+sexp_digest(item)
+        if 'Edge.Cuts' in layers:
+            common.update(data)
+            return
+        for la in layers:
+            d = per_layer.get(la)
+            if d is not None:
+                d.update(data)
+
+    for c in pcb[2][1:]:
+        head = sexp_head(c)
+        if head in SEXP_NOT_PLOTTED:
+            continue
+        if head in ('footprint', 'module'):
+            # Items on layers inherit the footprint data (position, side, etc.)
+            items = []
+            context = sha1()
+            for fc in c[2][1:]:
+                layers = sexp_layers(fc) if isinstance(fc, list) and sexp_head(fc) != 'layer' else None
+                if layers is None:
+                    write_sexp(context, fc)
+                else:
+                    items.append((fc, layers))
+            context = context.digest()
+            for fc, layers in items:
+                add(fc, expand_layers(layers, names), context)
+            continue
+        layers = copper_and_mask if head == 'via' else sexp_layers(c)
+        if layers is None:
+            write_sexp(common, c)
+        else:
+            add(c, expand_layers(layers, names))
+    common = common.hexdigest()
+    return {n: common+d.hexdigest() for n, d in per_layer.items()}
+
+
+def get_layer_digests(pcb_file, file_hash):
+    """ Per layer digests, cached """
+    hash_dir = cache_dir+sep+file_hash
+    digests = CacheGetValue(hash_dir, 'layer_digests')
+    if digests is None:
+        if not isfile(pcb_file):
+            # Using cached plots, we can't compute it
+            return {}
+        logger.debug('Computing the layer digests for '+pcb_file)
+        digests = layer_digests(pcb_file)
+        CacheSetValue(hash_dir, 'layer_digests', digests)
+    return digests
+
+
+def UnchangedLayers(old_file, old_file_hash, new_file, new_file_hash):
+    """ Names of the layers that we don't need to plot (--skip_unchanged) """
+    if not args.skip_unchanged or not is_pcb or args.kiri_mode:
+        return set()
+    old = get_layer_digests(old_file, old_file_hash)
+    new = get_layer_digests(new_file, new_file_hash)
+    unchanged = {la for la, d in new.items() if old.get(la) == d}
+    logger.info('Unchanged layers: '+', '.join(sorted(unchanged)))
+    return unchanged
+
+
 def thre_type(astr, min=0, max=1e6):
     value = int(astr)
     if min <= value <= max:
@@ -822,10 +2606,17 @@ def add_inner_layers():
             DEFAULT_LAYER_NAMES[pcbnew.In1_Cu+i-1] = name
 
 
+def get_font_file(fonts, font):
+    """ Extract the glyphs file for a font from the `-list font` output """
+    m = re.search(r'Font: '+re.escape(font)+r'\n(?:\s+\w+: .*\n)*?\s+glyphs: (.*)', fonts)
+    return m.group(1).strip() if m else None
+
+
 def check_image_magick():
     global CONVERT
     global FONT
-    if which("magick"):
+    global FONT_FILE
+    if find_tool("magick"):
         # Use new version of ImageMagick
         CONVERT = "magick"
         logger.debug("Using ImagMagick 7: magick")
@@ -834,14 +2625,16 @@ def check_image_magick():
         for font in ['NimbusSans-Regular', 'Open-Sans-Regular', 'Roboto', 'Helvetica']:
             if font in fonts:
                 FONT = font
+                FONT_FILE = get_font_file(fonts, font)
                 break
-    elif which('convert'):
+    elif find_tool('convert'):
         logger.debug("Using ImagMagick 6: convert")
         cmd = ['convert', '-list', 'font']
         fonts = run_command(cmd)
         for font in ['Helvetica', 'Open-Sans-Regular', 'Roboto']:
             if font in fonts:
                 FONT = font
+                FONT_FILE = get_font_file(fonts, font)
                 break
     else:
         logger.error('No convert or magick command, install ImageMagick')
@@ -849,14 +2642,55 @@ def check_image_magick():
     return cmd
 
 
-if __name__ == '__main__':
+def select_rasterizer():
+    rasterizer = 'gs' if args.force_gs else args.rasterizer
+    if rasterizer == 'pdfium' and not (has_pdfium and use_numpy):
+        logger.warning('The pdfium rasterizer needs pypdfium2 and the NumPy engine')
+        rasterizer = 'auto'
+    if rasterizer == 'pdfium' and args.band_height:
+        logger.warning('The pdfium rasterizer converts whole pages in memory, using pdftoppm for --band_height')
+        rasterizer = 'auto'
+    if rasterizer == 'auto':
+        jobs = args.jobs if args.jobs > 0 else cpu_count() or 1
+        rasterizer = 'pdfium' if has_pdfium and use_numpy else 'pdftoppm'
+        if rasterizer == 'pdfium' and args.band_height:
+            # pdftoppm output is copied to the raw bitmaps, the memory used doesn't depend on the page size
+            logger.info('Using pdftoppm for --band_height, pdfium converts whole pages in memory')
+            rasterizer = 'pdftoppm'
+        elif rasterizer == 'pdfium' and jobs > 1 and find_tool('pdftoppm') is not None:
+            # pdftoppm runs in parallel, and in background while plotting
+            logger.info('Using pdftoppm for {} jobs, pdfium converts only one page at a time'.format(jobs))
+            rasterizer = 'pdftoppm'
+    if rasterizer == 'pdftoppm' and find_tool('pdftoppm') is None:
+        rasterizer = 'gs'
+    if rasterizer == 'gs' and find_tool('gs') is None:
+        logger.error('No pdftoppm or ghostscript command, install poppler-utils or ghostscript')
+        exit(MISSING_TOOLS)
+    logger.debug('Converting PDFs using '+rasterizer)
+    return rasterizer
+
+
+def create_parser():
     parser = argparse.ArgumentParser(description='KiCad diff')
 
-    parser.add_argument('old_file', help='Original file (PCB/SCH)')
-    parser.add_argument('new_file', help='New file (PCB/SCH)')
+    parser.add_argument('old_file', help='Original file (PCB/SCH)', nargs='?')
+    parser.add_argument('new_file', help='New file (PCB/SCH)', nargs='?')
     parser.add_argument('--added_2color', help='Color used for added stuff in 2color mode', type=str, default='green')
     parser.add_argument('--all_pages', help='Compare all the schematic pages', action='store_true')
-    parser.add_argument('--cache_dir', help='Directory to cache images', type=str)
+    parser.add_argument('--batch', help='Compute the diffs listed in this file (JSON or CSV), see the docs', type=str)
+    parser.add_argument('--batch_report', help='Join the --batch diffs in one PDF (OUTPUT_DIR/OUTPUT_NAME)',
+                        action='store_true')
+    parser.add_argument('--band_height', help='Compute the diffs in bands of this number of rows, the memory used '
+                        "doesn't depend on the page size. Uses the raw bitmaps (see --raster_format)", type=int, default=0)
+    parser.add_argument('--cache_dir', '--cache', help='Directory to cache images', type=str)
+    parser.add_argument('--cache_gc', help='Just remove old entries from the cache, see --cache_max_*, no diff',
+                        action='store_true')
+    parser.add_argument('--cache_max_age', help='Remove cache entries not used in this number of days', type=float)
+    parser.add_argument('--cache_max_size', help='Remove the least recently used cache entries to keep the cache '
+                        'smaller than this size (in MB)', type=float)
+    parser.add_argument('--daemon', help='Run as a server for kicad-git-diff.py, using this Unix socket [%(const)s]',
+                        nargs='?', const=DAEMON_SOCKET, metavar='SOCKET')
+    parser.add_argument('--crop', help='Convert only the PCB area to bitmaps, plus a small margin', action='store_true')
     parser.add_argument('--diff_mode', help='How to compute the image difference [red_green]',
                         choices=['red_green', 'stats', '2color'], default='red_green')
     group = parser.add_mutually_exclusive_group()
@@ -864,21 +2698,37 @@ if __name__ == '__main__':
     parser.add_argument('--force_gs', help='Use Ghostscript even when Poppler is available', action='store_true')
     parser.add_argument('--fuzz', help='Color tolerance for diff stats mode [%(default)s]', type=int, choices=range(0, 101),
                         default=5, metavar='[0-100]')
+    parser.add_argument('--jobs', '-j', help='Number of parallel jobs, 0 means one for each CPU [%(default)s]', type=int,
+                        default=1)
     parser.add_argument('--keep_pngs', help="Don't remove the individual pages", action='store_true')
     parser.add_argument('--kiri_mode', help="Generate files compatible with KiRi", action='store_true')
     group.add_argument('--layers', help='Process layers in file (one layer per line)', type=str)
+    parser.add_argument('--mono', help='Convert the plots to black and white bitmaps, faster and using less memory',
+                        action='store_true')
     parser.add_argument('--new_file_hash', help='Use this hash for NEW_FILE', type=str)
+    parser.add_argument('--normalized_hash', help='Compute the file hashes ignoring changes that doesn\'t affect the '
+                        'plots (time stamps, UUIDs, etc.)', action='store_true')
     parser.add_argument('--no_reader', help="Don't open the PDF reader", action='store_false')
     parser.add_argument('--no_scour', help="Don't use scour even when available", action='store_true')
+    parser.add_argument('--no_tools_cache', help="Look for the tools, don't use the ones detected by a previous run",
+                        action='store_true')
     parser.add_argument('--no_exist_check', help="Don't check if files exists, must specify the cache hash",
                         action='store_true')
+    parser.add_argument('--no_numpy', help="Don't use NumPy to compute the diffs, even when available", action='store_true')
     parser.add_argument('--old_file_hash', help='Use this hash for OLD_FILE', type=str)
     parser.add_argument('--only_cache', help='Just populate the cache using OLD_FILE, no diff', action='store_true')
     parser.add_argument('--only_different', help='Only include the pages with differences', action='store_true')
     parser.add_argument('--output_dir', help='Directory for the output file', type=str)
     parser.add_argument('--output_name', help='Name of the output diff', type=str, default='diff.pdf')
+    parser.add_argument('--raster_format', help='Format for the cached bitmaps, raw is bigger but faster to load, '
+                        'needs the NumPy engine [%(default)s]', type=str, choices=('png', 'raw'), default='png')
+    parser.add_argument('--rasterizer', help='Tool used to convert the PDFs to bitmaps [%(default)s]', type=str,
+                        choices=('auto', 'pdftoppm', 'gs', 'pdfium'), default='auto')
     parser.add_argument('--removed_2color', help='Color used for removed stuff in 2color mode', type=str, default='red')
     parser.add_argument('--resolution', help='Image resolution in DPIs [%(default)s]', type=int, default=150)
+    parser.add_argument('--skip_unchanged', help="Don't plot the PCB layers that didn't change", action='store_true')
+    parser.add_argument('--single_pdf', help='Join all the PCB layers in one PDF and convert it using one pdftoppm run',
+                        action='store_true')
     parser.add_argument('--threshold', help='Error threshold for diff stats mode, 0 is no error [%(default)s]',
                         type=thre_type, default=0, metavar='[0-1000000]')
     parser.add_argument('--verbose', '-v', action='count', default=0)
@@ -886,13 +2736,14 @@ if __name__ == '__main__':
                         __copyright__+' - License: '+__license__)
     parser.add_argument('--zones', help='Un/Fill zones before creating the images', type=str,
                         choices=('fill', 'unfill', 'none'), default='none')
+    return parser
 
-    args = parser.parse_args()
 
-    # Fill the names for the inner layers
-    add_inner_layers()
-
-    # Create a logger with the specified verbosity
+def setup_logger():
+    """ Create a logger with the specified verbosity """
+    global VERB
+    global logger
+    VERB = None
     if args.verbose >= 2:
         log_level = logging.DEBUG
         VERB = "-" + ("v" * (args.verbose - 1))
@@ -901,36 +2752,192 @@ if __name__ == '__main__':
     else:
         log_level = logging.WARNING
     logging.basicConfig(level=log_level)
+    # The daemon jobs can use a different level
+    logging.getLogger().setLevel(log_level)
     logger = logging.getLogger(basename(__file__))
 
-    # Check the environment
-    cmd = check_image_magick()
+
+def find_tool(name):
+    """ Path to a tool, None if not in the PATH. The results are cached (see TOOLS_CACHE) """
+    if name not in tools:
+        tools[name] = which(name)
+    return tools[name]
+
+
+def mtime_ns(name):
+    try:
+        return stat(name).st_mtime_ns
+    except OSError:
+        return None
+
+
+def tools_key(found):
+    """ Things that invalidate the detected tools: the PATH directories (tools added or removed), the tools we found
+        (updated) and the KiCad module """
+    spec = find_spec('pcbnew')
+    pcbnew_file = spec.origin if spec is not None else None
+    return {'version': __version__,
+            'path': [[d, mtime_ns(d)] for d in environ.get('PATH', '').split(pathsep)],
+            'pcbnew': [pcbnew_file, mtime_ns(pcbnew_file) if pcbnew_file else None],
+            'tools': {name: mtime_ns(path) for name, path in found.items() if path}}
+
+
+def load_tools_cache():
+    """ Use the tools detected by a previous run, if nothing changed """
+    global CONVERT
+    global FONT
+    global FONT_FILE
+    global kicad_version
+    try:
+        with open(TOOLS_CACHE, 'rt') as f:
+            data = json.load(f)
+        if data['key'] != tools_key(data['tools']):
+            logger.debug('Tools cache outdated')
+            return False
+        tools.clear()
+        tools.update(data['tools'])
+        CONVERT = data['convert']
+        FONT = data['font']
+        FONT_FILE = data['font_file']
+        kicad_version = data['kicad_version']
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return False
+    logger.debug('Using the tools detected by a previous run ('+TOOLS_CACHE+')')
+    return True
+
+
+def save_tools_cache():
+    data = {'key': tools_key(tools), 'tools': tools, 'convert': CONVERT, 'font': FONT, 'font_file': FONT_FILE,
+            'kicad_version': kicad_version}
+    try:
+        makedirs(dirname(TOOLS_CACHE), exist_ok=True)
+        with atomic_open(TOOLS_CACHE) as f:
+            json.dump(data, f)
+    except OSError as e:
+        logger.debug('Unable to save the detected tools: '+str(e))
+
+
+def kicad_cli_version():
+    """ KiCad version reported by kicad-cli (KiCad 7 and newer), much faster than loading the KiCad module """
+    if find_tool('kicad-cli') is None:
+        return None
+    version = run_command(['kicad-cli', '--version'])
+    return version.strip() if re.search(r'\d+\.\d+\.\d+', version) else None
+
+
+def probe_tools():
+    """ Look for the tools in the PATH and run them to know their capabilities """
+    global kicad_version
+    tools.clear()
+    for name in PROBED_TOOLS:
+        find_tool(name)
+    check_image_magick()
+    kicad_version = kicad_cli_version()
+    if kicad_version is None:
+        # KiCad 5 and 6
+        load_pcbnew()
+        kicad_version = pcbnew.GetBuildVersion()
+
+
+def check_tools():
+    """ Detect the tools and the KiCad version. Done only once when running as daemon """
+    global kicad_version
+    global kicad_version_major
+    global kicad_version_minor
+    global kicad_version_patch
+    from_cache = not args.no_tools_cache and load_tools_cache()
+    if not from_cache:
+        probe_tools()
     # Check for available fonts
     if FONT:
         logger.debug("Using font: "+FONT)
     else:
         logger.error('No compatible Font found, install one of helvetica, Open-Sans-Regular or Roboto')
         exit(MISSING_TOOLS)
-    use_poppler = not args.force_gs
-    if which('pdftoppm') is None:
-        if which('gs') is None:
-            logger.error('No pdftoppm or ghostscript command, install poppler-utils or ghostscript')
-            exit(MISSING_TOOLS)
-        use_poppler = False
-    use_scour = not args.no_scour and which('scour') is not None
-    if args.no_reader and which('xdg-open') is None:
-        logger.warning('No xdg-open command, install xdg-utils. Disabling the PDF viewer.')
-        args.no_reader = False
-
     # KiCad version
-    kicad_version = GetBuildVersion()
     m = re.search(r'(\d+)\.(\d+)\.(\d+)', kicad_version)
     if m is None:
         logger.error("Unable to detect KiCad version, got: `{}`".format(kicad_version))
         exit(MISSING_TOOLS)
+    # Used for the cache entries, must be the same for kicad-cli and the KiCad module
+    kicad_version = m.group(0)
     kicad_version_major = int(m.group(1))
     kicad_version_minor = int(m.group(2))
     kicad_version_patch = int(m.group(3))
+    if not from_cache:
+        save_tools_cache()
+
+
+def parse_2color():
+    """ Colors for the 2color mode, as RGB values for the NumPy engine.
+        Returns False if Pillow doesn't know them, ImageMagick knows more names (i.e. gray50) """
+    global removed_rgb
+    global added_rgb
+    if args.diff_mode != '2color':
+        return True
+    try:
+        removed_rgb = ImageColor.getrgb(args.removed_2color)[:3]
+        added_rgb = ImageColor.getrgb(args.added_2color)[:3]
+    except ValueError as e:
+        logger.warning('{}, computing the diffs using ImageMagick'.format(e))
+        return False
+    return True
+
+
+def configure():
+    """ Tools selected using the command line options """
+    global use_numpy
+    global RASTERIZER
+    global use_single_pdf
+    global use_scour
+    use_numpy = has_numpy and not args.no_numpy and parse_2color()
+    logger.debug('Computing diffs using '+('NumPy' if use_numpy else 'ImageMagick'))
+    if args.band_height < 0:
+        logger.error('The band height must be positive')
+        exit(WRONG_ARGUMENT)
+    if args.band_height and not use_numpy:
+        logger.warning('The diffs can be computed in bands only by the NumPy engine')
+        args.band_height = 0
+    if args.band_height:
+        # Memory mapped, read band by band
+        args.raster_format = 'raw'
+    if args.raster_format == 'raw' and not use_numpy:
+        logger.warning('The raw bitmaps needs the NumPy engine')
+        args.raster_format = 'png'
+    RASTERIZER = select_rasterizer()
+    use_single_pdf = args.single_pdf
+    if use_single_pdf and (RASTERIZER != 'pdftoppm' or find_tool('pdfunite') is None):
+        logger.warning('The `--single_pdf` option needs pdftoppm and pdfunite (poppler-utils)')
+        use_single_pdf = False
+    use_scour = not args.no_scour and find_tool('scour') is not None
+    if args.no_reader and find_tool('xdg-open') is None:
+        logger.warning('No xdg-open command, install xdg-utils. Disabling the PDF viewer.')
+        args.no_reader = False
+
+
+def run_diff():
+    """ Compute the diff for the current command line options. Returns the output PDF """
+    global cache_dir
+    global output_dir
+    global resolution
+    global layer_list
+    global is_exclude
+    global is_pcb
+    global svg_mode
+    global cur_sch_ops
+    global cur_pcb_ops
+    if args.cache_dir:
+        cache_dir = args.cache_dir
+        if not isdir(cache_dir):
+            makedirs(cache_dir, exist_ok=True)
+        logger.debug('Cache dir: %s' % cache_dir)
+    else:
+        if args.only_cache:
+            logger.error('Asking to populate the cache, but no cache dir specified')
+            exit(ARGS_ERROR)
+        cache_dir = mkdtemp()
+        logger.debug('Temporal cache dir %s' % cache_dir)
+        atexit.register(CleanCacheDir)
 
     # Check the arguments
     old_file = args.old_file
@@ -940,7 +2947,7 @@ if __name__ == '__main__':
     if args.old_file_hash:
         old_file_hash = args.old_file_hash
     else:
-        old_file_hash = GetDigest(old_file)
+        old_file_hash = FileDigest(old_file)
     logger.debug('{} SHA1 is {}'.format(old_file, old_file_hash))
 
     new_file = args.new_file
@@ -951,22 +2958,9 @@ if __name__ == '__main__':
     if args.new_file_hash:
         new_file_hash = args.new_file_hash
     elif not args.only_cache:
-        new_file_hash = GetDigest(new_file)
+        new_file_hash = FileDigest(new_file)
     logger.debug('{} SHA1 is {}'.format(new_file, new_file_hash))
 
-    if args.cache_dir:
-        cache_dir = args.cache_dir
-        if not isdir(cache_dir):
-            makedirs(cache_dir, exist_ok=True)
-        logger.debug('Cache dir: %s' % cache_dir)
-    else:
-        if args.only_cache:
-            logger.error('Asking to populate the cache, but no cache dir specified')
-            exit(ARGS_ERROR)
-        cache_dir = mkdtemp()
-        logger.debug('Temporal cache dir %s' % cache_dir)
-        atexit.register(CleanCacheDir)
-
     if args.output_dir:
         output_dir = args.output_dir
         if not isdir(output_dir):
@@ -977,6 +2971,8 @@ if __name__ == '__main__':
         logger.debug('Temporal output dir %s' % output_dir)
         atexit.register(CleanOutputDir)
 
+    if args.jobs <= 0:
+        args.jobs = cpu_count() or 1
     resolution = args.resolution
     if resolution < 30 or resolution > 400:
         logger.warning('Resolution outside the recommended range [30,400]')
@@ -995,32 +2991,349 @@ if __name__ == '__main__':
 
     # Are we using PCBs or SCHs?
     is_pcb = old_file.endswith('.kicad_pcb')
+    if is_pcb:
+        load_pcbnew()
+        # Fill the names for the inner layers
+        add_inner_layers()
 
-    if not is_pcb and which('eeschema_do') is None:
+    if not is_pcb and find_tool('eeschema_do') is None:
         logger.error('No eeschema_do command, install KiAuto')
         exit(MISSING_TOOLS)
 
     # The SVG mode allows comparing individual pages in a way that we can detect added/removed pages
     svg_mode = False
     if not is_pcb and args.all_pages:
-        svg_mode = which('rsvg-convert') is not None
+        svg_mode = has_cairosvg or find_tool('rsvg-convert') is not None
         if not svg_mode:
-            logger.warning("The `rsvg-convert` tool isn't installed:")
+            logger.warning("The `rsvg-convert` tool (or CairoSVG) isn't installed:")
             logger.warning("- If the number of pages changed the process will be aborted.")
 
     cur_sch_ops = {'KiCad': kicad_version}
     cur_pcb_ops = {'KiCad': kicad_version, 'zones': args.zones}
 
-    layers_old, bbox_old = GenImages(old_file, old_file_hash, args.all_pages, args.zones, args.kiri_mode)
     if args.only_cache:
+        # We don't know which flavor will be needed, plot both
+        LockCacheEntries(old_file_hash)
+        GenImages(old_file, old_file_hash, args.all_pages, args.zones, args.kiri_mode)
         logger.info('{} SHA1 is {}'.format(old_file, old_file_hash))
+        UnlockCacheEntries()
+        CacheGC([old_file_hash])
         exit(0)
-    layers_new, bbox_new = GenImages(new_file, new_file_hash, args.all_pages, args.zones)
+    output_pdf = PlotAndDiff(old_file, old_file_hash, new_file, new_file_hash)
+    CacheGC([old_file_hash, new_file_hash])
+    return output_pdf
 
-    zero_size = (0, 0, 0, 0)
-    changed = bbox_old != bbox_new and bbox_old != zero_size and bbox_new != zero_size
-    output_pdf = DiffImages(old_file_hash, new_file_hash, layers_old, layers_new, args.only_different, changed)
 
-    if args.no_reader:
+def exit_code(e):
+    """ Exit code for a SystemExit exception """
+    if e.code is None:
+        return 0
+    return e.code if isinstance(e.code, int) else INTERNAL_ERROR
+
+
+def load_batch(name):
+    """ Read the diffs for --batch, a JSON list of objects or a CSV file with a header, using BATCH_FIELDS """
+    try:
+        with open(name, 'rt') as f:
+            if name.endswith('.json'):
+                diffs = json.load(f)
+            else:
+                diffs = list(csv.DictReader(f))
+    except (OSError, ValueError, csv.Error) as e:
+        logger.error('Unable to load the batch file `{}`: {}'.format(name, e))
+        exit(WRONG_ARGUMENT)
+    if not isinstance(diffs, list):
+        logger.error('The batch file must contain a list of diffs')
+        exit(WRONG_ARGUMENT)
+    for n, d in enumerate(diffs):
+        if not isinstance(d, dict) or not d.get('old_file') or not d.get('new_file'):
+            logger.error('Diff {} in the batch file: missing old_file and/or new_file'.format(n+1))
+            exit(WRONG_ARGUMENT)
+        unknown = set(d.keys())-set(BATCH_FIELDS)
+        if unknown:
+            logger.error('Diff {} in the batch file: unknown fields {}'.format(n+1, ', '.join(sorted(unknown))))
+            exit(WRONG_ARGUMENT)
+    if not diffs:
+        logger.error('Nothing to compare!')
+        exit(NOTHING_TO_COMPARE)
+    return diffs
+
+
+def batch_job(n, diff, jobs):
+    """ Compute one of the --batch diffs. We are a fork of the batch process """
+    global args
+    args = argparse.Namespace(**vars(args))
+    args.batch = None
+    args.jobs = jobs
+    args.old_file = diff['old_file']
+    args.new_file = diff['new_file']
+    args.old_file_hash = diff.get('old_file_hash') or None
+    args.new_file_hash = diff.get('new_file_hash') or None
+    args.output_dir = batch_dir(n, diff)
+    try:
+        run_diff()
+        code = 0
+    except SystemExit as e:
+        code = exit_code(e)
+    except Exception:
+        logger.exception('Diff {} failed'.format(n+1))
+        code = INTERNAL_ERROR
+    stdout.flush()
+    stderr.flush()
+    # Skip the exit handlers, they belong to the batch process (i.e. temporal cache)
+    _exit(code)
+
+
+def batch_dir(n, diff):
+    return join(output_dir, '{:03d}-{}'.format(n+1, splitext(basename(diff['new_file']))[0]))
+
+
+def wait_batch_job(running, codes):
+    pid, status = waitpid(-1, 0)
+    n = running.pop(pid)
+    codes[n] = 128+WTERMSIG(status) if WIFSIGNALED(status) else WEXITSTATUS(status)
+
+
+def create_title(name, text):
+    """ Page used to separate the diffs in the --batch_report """
+    png = name+'.png'
+    cmd = [CONVERT, '-size', '640x480', '-background', 'white', '-fill', 'black', '-pointsize', '32', '-gravity', 'center',
+           'label:'+text, png]
+    run_command(cmd)
+    pdf = pdf_open(name+'.pdf')
+    pdf_add_png(pdf, png)
+    pdf['f'].close()
+    remove(png)
+    return pdf['name']
+
+
+def join_pdfs(files, out_name):
+    if find_tool('pdfunite'):
+        call(['pdfunite']+files+[out_name])
+    elif has_pdfium:
+        pdf = pdfium.PdfDocument.new()
+        for f in files:
+            pdf.import_pages(pdfium.PdfDocument(f))
+        pdf.save(out_name)
+    elif find_tool('gs'):
+        call(['gs', '-q', '-dNOPAUSE', '-dBATCH', '-sDEVICE=pdfwrite', '-sOutputFile='+out_name]+files)
+    else:
+        logger.error('No pdfunite, pypdfium2 or ghostscript to join the PDFs')
+        exit(MISSING_TOOLS)
+
+
+def BatchReport(diffs, codes):
+    """ Join the diffs in one PDF, with a title page for each one """
+    files = []
+    titles = []
+    for n, (diff, code) in enumerate(zip(diffs, codes)):
+        if code:
+            continue
+        pdf = join(batch_dir(n, diff), args.output_name)
+        title = create_title(join(output_dir, 'title-{:03d}'.format(n+1)), diff.get('name') or diff['new_file'])
+        titles.append(title)
+        files.extend((title, pdf))
+    if not files:
+        logger.error('Nothing to compare!')
+        exit(NOTHING_TO_COMPARE)
+    out_name = join(output_dir, args.output_name)
+    logger.info('Joining all the diffs into one PDF')
+    join_pdfs(files, out_name)
+    if not isfile(out_name):
+        logger.error('Failed to join diffs into %s' % out_name)
+        exit(FAILED_TO_JOIN)
+    for f in titles:
+        remove(f)
+    return out_name
+
+
+def run_batch():
+    """ Compute the diffs listed in the --batch file. Each diff is computed by a fork of this process, so they share
+        the tools detection and the KiCad module. Returns the combined report (see --batch_report) """
+    global cache_dir
+    global output_dir
+    diffs = load_batch(args.batch)
+    if not args.output_dir and not args.batch_report:
+        logger.error('Use --output_dir and/or --batch_report to get the --batch results')
+        exit(ARGS_ERROR)
+    if any(d['old_file'].endswith('.kicad_pcb') for d in diffs):
+        load_pcbnew()
+    if not args.cache_dir:
+        # Shared by all the diffs
+        cache_dir = args.cache_dir = mkdtemp()
+        logger.debug('Temporal cache dir %s' % cache_dir)
+        atexit.register(CleanCacheDir)
+    if args.output_dir:
+        output_dir = args.output_dir
+        makedirs(output_dir, exist_ok=True)
+    else:
+        output_dir = mkdtemp()
+        logger.debug('Temporal output dir %s' % output_dir)
+        atexit.register(CleanOutputDir)
+    if args.jobs <= 0:
+        args.jobs = cpu_count() or 1
+    # Diffs computed at the same time, and jobs used by each one
+    parallel = min(args.jobs, len(diffs))
+    jobs = max(1, args.jobs // parallel)
+    running = {}
+    codes = [None]*len(diffs)
+    for n, diff in enumerate(diffs):
+        if len(running) >= parallel:
+            wait_batch_job(running, codes)
+        logger.info('Diff {}/{}: {} vs {}'.format(n+1, len(diffs), diff['old_file'], diff['new_file']))
+        stdout.flush()
+        stderr.flush()
+        pid = fork()
+        if pid == 0:
+            batch_job(n, diff, jobs)
+        running[pid] = n
+    while running:
+        wait_batch_job(running, codes)
+    failed = [(n, code) for n, code in enumerate(codes) if code]
+    for n, code in failed:
+        logger.error('Diff {} ({} vs {}) failed, error {}'.format(n+1, diffs[n]['old_file'], diffs[n]['new_file'], code))
+    output_pdf = BatchReport(diffs, codes) if args.batch_report else None
+    if failed:
+        open_viewer(output_pdf)
+        exit(failed[0][1])
+    return output_pdf
+
+
+def open_viewer(output_pdf):
+    if args.no_reader and output_pdf is not None:
         Popen(['xdg-open', output_pdf], start_new_session=True, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
         time.sleep(5)
+
+
+def peer_uid(conn):
+    """ User ID of the process connected to a Unix socket """
+    return unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, calcsize('3i')))[1]
+
+
+def daemon_job(conn, parser):
+    """ Run a job for a client. We are a fresh fork of the daemon, so the tools are already detected.
+        The client sends its stdout and stderr, we use them for all the messages.
+        The exit code is sent before waiting for the PDF viewer """
+    global args
+    if peer_uid(conn) != getuid():
+        # Only our user can use the socket, but the permissions are set after creating it
+        exit(ARGS_ERROR)
+    msg, anc, _, _ = conn.recvmsg(65536, socket.CMSG_LEN(2*array.array('i').itemsize))
+    fds = array.array('i')
+    for level, kind, data in anc:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data)-(len(data) % fds.itemsize)])
+    while not msg.endswith(b'\n'):
+        data = conn.recv(65536)
+        if not data:
+            exit(ARGS_ERROR)
+        msg += data
+    for fd, std in zip(fds, (1, 2)):
+        dup2(fd, std)
+        close(fd)
+    request = json.loads(msg.decode())
+    chdir(request['cwd'])
+    output_pdf = None
+    try:
+        args = parser.parse_args(request['argv'])
+        setup_logger()
+        check_files_args(parser)
+        configure()
+        output_pdf = run_batch() if args.batch else run_diff()
+        code = 0
+    except SystemExit as e:
+        code = exit_code(e)
+    except Exception:
+        # The client gets the traceback
+        logger.exception('The job failed')
+        code = INTERNAL_ERROR
+    stdout.flush()
+    stderr.flush()
+    conn.sendall(json.dumps({'code': code}).encode()+b'\n')
+    conn.close()
+    if output_pdf is not None:
+        open_viewer(output_pdf)
+    exit(code)
+
+
+def Daemon(parser):
+    """ Server mode, used to avoid the start-up time (loading pcbnew and detecting the tools).
+        kicad-git-diff.py connects to the socket and sends the command line, we fork to run each job. """
+    socket_name = args.daemon
+    if not hasattr(socket, 'SO_PEERCRED'):
+        logger.error('The daemon mode needs to identify the clients (SO_PEERCRED), not supported by this system')
+        exit(ARGS_ERROR)
+    check_tools()
+    # The jobs inherit the KiCad module
+    load_pcbnew()
+    socket_dir = dirname(abspath(socket_name))
+    makedirs(socket_dir, mode=0o700, exist_ok=True)
+    if socket_name == DAEMON_SOCKET:
+        # The default could be in the shared temporal dir, other users could create it
+        st = stat(socket_dir)
+        if st.st_uid != getuid() or st.st_mode & 0o077:
+            logger.error('`{}` must be a directory only accessible by the current user'.format(socket_dir))
+            exit(ARGS_ERROR)
+    if exists(socket_name):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(socket_name)
+            logger.error('Another daemon is using `{}`'.format(socket_name))
+            exit(ARGS_ERROR)
+        except OSError:
+            # Left by a dead daemon
+            remove(socket_name)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_name)
+    chmod(socket_name, 0o600)
+    server.listen()
+    atexit.register(remove, socket_name)
+    # We don't wait for the jobs, the clients get the exit code from them
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    # Remove the socket when killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+    logger.info('Waiting for jobs at `{}`'.format(socket_name))
+    while True:
+        conn, _ = server.accept()
+        # A SIGTERM received while forking is lost (the exception is ignored by the fork handlers)
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        if fork() == 0:
+            server.close()
+            atexit.unregister(remove)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+            daemon_job(conn, parser)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+        conn.close()
+
+
+def check_files_args(parser):
+    if args.batch:
+        if args.old_file is not None:
+            parser.error('the files to compare must be in the --batch file')
+    elif args.old_file is None or args.new_file is None:
+        parser.error('the following arguments are required: old_file, new_file')
+
+
+def main(argv=None):
+    global args
+    parser = create_parser()
+    args = parser.parse_args(argv)
+
+    setup_logger()
+
+    if args.daemon:
+        Daemon(parser)
+    if args.cache_gc:
+        CacheGCOnly()
+    check_files_args(parser)
+
+    # Check the environment
+    check_tools()
+    configure()
+    open_viewer(run_batch() if args.batch else run_diff())
+
+
+if __name__ == '__main__':
+    main()
@@ -20,27 +20,134 @@ __status__ = 'beta'
 __url__ = 'https://github.com/INTI-CMNB/KiDiff/'
 
 import argparse
+import array
+from hashlib import sha1
+import json
 import logging
-from os.path import isfile, isdir, basename, sep, dirname, realpath
-from os import getcwd, mkdir
-from subprocess import call
+from os.path import isfile, isdir, basename, sep, dirname, realpath, join, abspath
+from os import getcwd, mkdir, makedirs, environ, getuid, chdir
+import socket
+from struct import calcsize, unpack
+from subprocess import call, check_output, CalledProcessError
 from sys import exit
+from tempfile import gettempdir, mkdtemp
+from shutil import rmtree
 
 # Exit error codes
 OLD_PCB_INVALID = 1
 NEW_PCB_INVALID = 2
+INTERNAL_ERROR = 3
+# Default Unix socket for the kicad-diff.py daemon (see --daemon), in a private directory
+DAEMON_SOCKET = (join(environ['XDG_RUNTIME_DIR'], 'kidiff-{}.sock'.format(getuid())) if environ.get('XDG_RUNTIME_DIR') else
+                 join(gettempdir(), 'kidiff-{}'.format(getuid()), 'daemon.sock'))
+
+
+def git_blob_hash(file, name):
+    """ The hash git will use for the file once committed, so the cache entry is reused after committing """
+    try:
+        # Applies the same filters (i.e. end of line conversion) git will apply
+        return check_output(['git', 'hash-object', '--path='+name, file]).decode().strip()
+    except (OSError, CalledProcessError):
+        with open(file, 'rb') as f:
+            data = f.read()
+        return sha1(b'blob '+str(len(data)).encode()+b'\0'+data).hexdigest()
+
+
+def git_blob(name, rev, tmp_dir):
+    """ Extract a file from git, returns the file name and its hash """
+    blob_hash = check_output(['git', 'rev-parse', rev+':'+name]).decode().strip()
+    file = join(tmp_dir, blob_hash, basename(name))
+    makedirs(dirname(file), exist_ok=True)
+    with open(file, 'wb') as f:
+        f.write(check_output(['git', 'cat-file', 'blob', blob_hash]))
+    return file, blob_hash
+
+
+def range_batch(revs, tmp_dir):
+    """ Create a kicad-diff.py --batch file for the PCBs/SCHs changed in a range of revisions (OLD..NEW or just OLD to
+        compare with the working tree) """
+    old_rev, _, new_rev = revs.partition('..')
+    cmd = ['git', 'diff', '--name-only', '--diff-filter=M', '-z', old_rev]
+    if new_rev:
+        cmd.append(new_rev)
+    names = check_output(cmd+['--', '*.kicad_pcb', '*.kicad_sch']).decode().split('\0')
+    diffs = []
+    for name in filter(None, names):
+        old_file, old_hash = git_blob(name, old_rev, tmp_dir)
+        if new_rev:
+            new_file, new_hash = git_blob(name, new_rev, tmp_dir)
+        else:
+            new_file = name
+            new_hash = git_blob_hash(name, name)
+        diff = {'name': name, 'old_file': old_file, 'new_file': new_file}
+        if not args.normalized_hash:
+            diff['old_file_hash'] = old_hash
+            diff['new_file_hash'] = new_hash
+        diffs.append(diff)
+    logger.debug('Changed files: '+str([d['name'] for d in diffs]))
+    batch = join(tmp_dir, 'batch.json')
+    with open(batch, 'wt') as f:
+        json.dump(diffs, f)
+    return batch
+
+
+def run_daemon(command, socket_name):
+    """ Ask a kicad-diff.py daemon to run the command, returns its exit code.
+        Returns None if no daemon is running. """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_name)
+        # We send our stdout/stderr and command line, make sure the daemon is ours, not from another user
+        uid = unpack('3i', s.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, calcsize('3i')))[1]
+    except (OSError, AttributeError):
+        # AttributeError: no SO_PEERCRED, we can't check it
+        s.close()
+        return None
+    if uid != getuid():
+        logger.warning('Ignoring the daemon at `{}`, belongs to another user'.format(socket_name))
+        s.close()
+        return None
+    logger.debug('Using the daemon at '+socket_name)
+    reply = b''
+    with s:
+        try:
+            # The daemon uses our stdout and stderr
+            msg = json.dumps({'argv': command[1:], 'cwd': getcwd()}).encode()+b'\n'
+            sent = s.sendmsg([msg], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [1, 2]))])
+            s.sendall(msg[sent:])
+            while not reply.endswith(b'\n'):
+                data = s.recv(4096)
+                if not data:
+                    break
+                reply += data
+        except OSError:
+            # i.e. the daemon rejected us without reading the command
+            pass
+    if not reply.endswith(b'\n'):
+        logger.error('The kicad-diff.py daemon aborted the job')
+        return INTERNAL_ERROR
+    return json.loads(reply.decode())['code']
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='KiCad diff wrapper for Git')
 
-    parser.add_argument('old_file_name', help='PCB/SCH name')
-    parser.add_argument('old_file_file', help='Original PCB/SCH file')
-    parser.add_argument('old_file_hash', help='Original PCB/SCH hash')
-    parser.add_argument('old_file_perm', help='Original PCB/SCH perms')
-    parser.add_argument('new_file_file', help='New PCB/SCH file')
-    parser.add_argument('new_file_hash', help='New PCB/SCH hash')
-    parser.add_argument('new_file_perm', help='New PCB/SCH perms')
+    parser.add_argument('old_file_name', help='PCB/SCH name', nargs='?')
+    parser.add_argument('old_file_file', help='Original PCB/SCH file', nargs='?')
+    parser.add_argument('old_file_hash', help='Original PCB/SCH hash', nargs='?')
+    parser.add_argument('old_file_perm', help='Original PCB/SCH perms', nargs='?')
+    parser.add_argument('new_file_file', help='New PCB/SCH file', nargs='?')
+    parser.add_argument('new_file_hash', help='New PCB/SCH hash', nargs='?')
+    parser.add_argument('new_file_perm', help='New PCB/SCH perms', nargs='?')
 
+    parser.add_argument('--cache_max_age', nargs=1, help='Remove cache entries not used in this number of days')
+    parser.add_argument('--cache_max_size', nargs=1, help='Maximum size for the cache (in MB)')
+    parser.add_argument('--normalized_hash', help='Use the file contents to compute the hashes, ignoring time stamps, '
+                        'UUIDs, etc.', action='store_true')
+    parser.add_argument('--output_dir', help='Directory for the --range diffs, by default they are just displayed')
+    parser.add_argument('--range', help='Compare all the PCBs/SCHs changed between two revisions (OLD..NEW), or between '
+                        'a revision and the working tree (OLD), in one report')
+    parser.add_argument('--socket', help='Unix socket for the kicad-diff.py daemon [%(default)s]', default=DAEMON_SOCKET)
     parser.add_argument('--resolution', nargs=1, help='Image resolution in DPIs [150]', default=['150'])
     parser.add_argument('--verbose', '-v', action='count', default=0)
     parser.add_argument('--version', action='version', version='%(prog)s '+__version__+' - ' +
@@ -62,15 +169,32 @@ if __name__ == '__main__':
     logger = logging.getLogger(basename(__file__))
 
     # Check the arguments
-    old_file = args.old_file_file
-    if not isfile(old_file):
-        logger.error('%s isn\'t a valid file name' % old_file)
-        exit(OLD_PCB_INVALID)
+    if args.range:
+        # Work from the root of the repo, like when invoked by git
+        if args.output_dir:
+            args.output_dir = abspath(args.output_dir)
+        try:
+            chdir(check_output(['git', 'rev-parse', '--show-toplevel']).decode().strip())
+        except (OSError, CalledProcessError):
+            exit(INTERNAL_ERROR)
+        tmp_dir = mkdtemp()
+        try:
+            batch = range_batch(args.range, tmp_dir)
+        except CalledProcessError:
+            rmtree(tmp_dir)
+            exit(INTERNAL_ERROR)
+    else:
+        if args.new_file_perm is None:
+            parser.error('git must provide 7 arguments, or use --range')
+        old_file = args.old_file_file
+        if not isfile(old_file):
+            logger.error('%s isn\'t a valid file name' % old_file)
+            exit(OLD_PCB_INVALID)
 
-    new_file = args.new_file_file
-    if not isfile(new_file):
-        logger.error('%s isn\'t a valid file name' % new_file)
-        exit(NEW_PCB_INVALID)
+        new_file = args.new_file_file
+        if not isfile(new_file):
+            logger.error('%s isn\'t a valid file name' % new_file)
+            exit(NEW_PCB_INVALID)
 
     resolution = int(args.resolution[0])
 
@@ -88,21 +212,41 @@ if __name__ == '__main__':
                 logger.error('can\'t create cache dir ('+dir_cache+')')
                 dir_cache = None
 
-    command = [dirname(realpath(__file__))+sep+'kicad-diff.py', '--all_pages', '--resolution', str(resolution),
-               '--old_file_hash', args.old_file_hash]
-    if int(args.new_file_hash, 16):
-        # When we compare to the currently modified file git uses 0 as hash
-        # If we use it all files that we didn't yet commit become the same
-        command += ['--new_file_hash', args.new_file_hash]
+    command = [dirname(realpath(__file__))+sep+'kicad-diff.py', '--all_pages', '--resolution', str(resolution)]
+    if args.normalized_hash:
+        # kicad-diff.py computes the hashes, so equivalent revisions share the cache
+        command.append('--normalized_hash')
+    elif not args.range:
+        command += ['--old_file_hash', args.old_file_hash]
+        new_file_hash = args.new_file_hash
+        if not int(new_file_hash, 16):
+            # When we compare to the currently modified file git uses 0 as hash
+            # If we use it all files that we didn't yet commit become the same
+            new_file_hash = git_blob_hash(new_file, args.old_file_name)
+        command += ['--new_file_hash', new_file_hash]
     if verb is not None:
         command.append(verb)
     if dir_cache is not None:
         command.append('--cache_dir')
         command.append(dir_cache)
+        if args.cache_max_age:
+            command += ['--cache_max_age', args.cache_max_age[0]]
+        if args.cache_max_size:
+            command += ['--cache_max_size', args.cache_max_size[0]]
     if isfile('.kicad-git-diff'):
         command.append('--exclude')
         command.append('.kicad-git-diff')
-    command.append(old_file)
-    command.append(new_file)
+    if args.range:
+        command += ['--batch', batch, '--batch_report']
+        if args.output_dir:
+            command += ['--output_dir', args.output_dir]
+    else:
+        command.append(old_file)
+        command.append(new_file)
     logger.debug(command)
-    call(command)
+    res = run_daemon(command, args.socket)
+    if res is None:
+        res = call(command)
+    if args.range:
+        rmtree(tmp_dir)
+        exit(res)
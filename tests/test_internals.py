@@ -0,0 +1,818 @@
+# Copyright (c) 2026 Salvador E. Tropea
+# Copyright (c) 2026 Instituto Nacional de Tecnologïa Industrial
+# License: GPL-2.0
+# Project: KiCad Diff (KiDiff)
+"""
+Tests for the functions that don't need KiCad
+
+The script is loaded as a module. NumPy and Pillow are needed for the
+bitmap tests, pypdfium2 is used to check the generated PDFs.
+
+For debug information use:
+pytest-3 --log-cli-level debug
+
+"""
+
+import argparse
+import hashlib
+import importlib.util
+import logging
+import os
+import re
+import multiprocessing
+import shutil
+import subprocess
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import pytest
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = None
+script_dir = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location('kicad_diff', os.path.join(os.path.dirname(script_dir), 'kicad-diff.py'))
+kd = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(kd)
+kd.logger = logging.getLogger('kicad-diff')
+spec = importlib.util.spec_from_file_location('kicad_git_diff',
+                                              os.path.join(os.path.dirname(script_dir), 'kicad-git-diff.py'))
+kgd = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(kgd)
+kgd.logger = logging.getLogger('kicad-git-diff')
+CASES = os.path.join(script_dir, 'cases')
+needs_numpy = pytest.mark.skipif(np is None, reason='needs NumPy and Pillow')
+
+
+def setup_args(*ops):
+    kd.args = kd.create_parser().parse_args(list(ops)+['a', 'b'])
+    kd.resolution = 150
+    kd.crop_window = None
+    kd.FONT_FILE = None
+
+
+def create_pngs(tmp_path):
+    """ PNGs using the color types we generate: gray, RGB, palette (2 bits) and 1 bit """
+    rng = np.random.default_rng(1)
+    gray = rng.integers(0, 256, (40, 51), dtype=np.uint8)
+    rgb = rng.integers(0, 256, (40, 51, 3), dtype=np.uint8)
+    pal = Image.fromarray(rng.integers(0, 4, (40, 51), dtype=np.uint8), 'P')
+    pal.putpalette(bytes((255, 255, 255, 255, 0, 0, 0, 255, 0, 0, 0, 0)))
+    images = {'gray': Image.fromarray(gray), 'rgb': Image.fromarray(rgb), 'pal': pal,
+              'bw': Image.fromarray(gray > 127)}
+    pngs = {}
+    for name, img in images.items():
+        png = str(tmp_path / (name+'.png'))
+        img.save(png, dpi=(150, 150), bits=2 if name == 'pal' else 8)
+        pngs[png] = np.asarray(img.convert('RGB'))
+    return pngs
+
+
+@needs_numpy
+def test_pdf_writer_1(tmp_path):
+    """ The pages of the PDF are the PNGs, the PDF is valid after adding each page """
+    pdfium = pytest.importorskip('pypdfium2')
+    setup_args()
+    pngs = create_pngs(tmp_path)
+    name = str(tmp_path / 'out.pdf')
+    pdf = kd.pdf_open(name)
+    for n, png in enumerate(pngs, start=1):
+        kd.pdf_add_png(pdf, png)
+        partial = str(tmp_path / 'partial{}.pdf'.format(n))
+        shutil.copy(name, partial)
+        doc = pdfium.PdfDocument(partial)
+        assert len(doc) == n
+        doc.close()
+    pdf['f'].close()
+    doc = pdfium.PdfDocument(name)
+    for page, (png, ref) in zip(doc, pngs.items()):
+        assert tuple(round(v) for v in page.get_size()) == (round(ref.shape[1]*72/150), round(ref.shape[0]*72/150))
+        img = np.asarray(page.render(scale=150/72).to_pil().convert('RGB'))
+        assert img.shape == ref.shape, png
+        assert np.array_equal(img, ref), png
+    doc.close()
+
+
+@needs_numpy
+def test_2color_1():
+    """ 2color diffs using the NumPy engine, colors unknown by Pillow must use ImageMagick """
+    setup_args('--diff_mode', '2color', '--added_2color', 'blue')
+    assert kd.parse_2color()
+    old = np.full((4, 4), 255, dtype=np.uint8)
+    new = old.copy()
+    old[0, 0] = 0
+    img, changes = kd.np_stereo_colored(old, new)
+    assert changes == 1
+    assert tuple(img[0, 0]) == (255, 0, 0)
+    new[1, 1] = 0
+    img, changes = kd.np_stereo_colored(old, new)
+    assert tuple(img[1, 1]) == (0, 0, 255)
+    assert kd.np_stereo_colored(old, old)[1] == 0
+    setup_args('--diff_mode', '2color', '--removed_2color', 'gray50')
+    assert not kd.parse_2color()
+    # Only used for 2color
+    setup_args('--removed_2color', 'gray50')
+    assert kd.parse_2color()
+
+
+def test_select_rasterizer_1(monkeypatch):
+    """ pdfium is used only for one job, pdftoppm can convert many pages in parallel """
+    monkeypatch.setattr(kd, 'has_pdfium', True)
+    monkeypatch.setattr(kd, 'use_numpy', True)
+    monkeypatch.setattr(kd, 'find_tool', lambda name: '/usr/bin/'+name)
+    for ops, rasterizer in ((['--jobs', '1'], 'pdfium'), (['--jobs', '4'], 'pdftoppm'),
+                            (['--jobs', '1', '--band_height', '64'], 'pdftoppm'),
+                            (['--jobs', '4', '--rasterizer', 'pdfium'], 'pdfium'),
+                            (['--jobs', '1', '--rasterizer', 'gs'], 'gs')):
+        setup_args(*ops)
+        assert kd.select_rasterizer() == rasterizer, ops
+    # No pdftoppm, pdfium is better than gs
+    monkeypatch.setattr(kd, 'find_tool', lambda name: None if name == 'pdftoppm' else '/usr/bin/'+name)
+    setup_args('--jobs', '4')
+    assert kd.select_rasterizer() == 'pdfium'
+    monkeypatch.setattr(kd, 'use_numpy', False)
+    assert kd.select_rasterizer() == 'gs'
+
+
+def test_crop_window_1(monkeypatch):
+    """ Area containing both PCBs, plus the margin, in pixels """
+    setup_args('--crop')
+    kd.resolution = 254
+    # 10 pixels for each mm
+    assert kd.GetCropWindow((20, 30, 10, 5), (25, 20, 10, 5)) == (150, 150, 251, 251)
+    # Empty PCBs are ignored, the window is clipped to the page
+    assert kd.GetCropWindow((2, 3, 10, 5), (0, 0, 0, 0)) == (0, 0, 171, 131)
+    assert kd.GetCropWindow((0, 0, 0, 0), (0, 0, 0, 0)) is None
+    # Cropping needs the 1:1 plots
+    monkeypatch.setattr(kd, 'crop_window', None)
+    assert kd.SelectFlavor((20, 30, 10, 5), (20, 30, 10, 5))
+    assert kd.crop_window == (150, 250, 201, 151)
+    assert kd.pdftoppm_crop() == ['-x', '150', '-y', '250', '-W', '201', '-H', '151']
+    monkeypatch.setattr(kd, 'RASTERIZER', 'pdftoppm')
+    assert kd.raster_flavor() == 'pdftoppm_gray_crop201x151+150+250'
+
+
+@needs_numpy
+def test_crop_pdfium_1(tmp_path, monkeypatch):
+    """ pdfium crops the page to exactly the window size """
+    pdfium = pytest.importorskip('pypdfium2')
+    monkeypatch.setattr(kd, 'pdfium', pdfium, raising=False)
+    setup_args()
+    img = np.full((200, 300), 255, dtype=np.uint8)
+    img[50:90, 100:180] = 0
+    pdf = str(tmp_path / 'page.pdf')
+    # 1 pixel is 1 point
+    Image.fromarray(img).save(pdf, resolution=72)
+    kd.resolution = 72
+    kd.crop_window = (90, 40, 100, 60)
+    page = kd.pdf2array_pdfium(pdf)[0]
+    assert page.shape == (60, 100)
+    assert np.array_equal(page < 128, img[40:100, 90:190] < 128)
+
+
+def use_cache(tmp_path, monkeypatch, *ops):
+    cache = tmp_path / 'cache'
+    cache.mkdir()
+    monkeypatch.setattr(kd, 'cache_dir', str(cache), raising=False)
+    monkeypatch.setattr(kd, 'cache_dbs', {})
+    setup_args('--cache_dir', str(cache), *ops)
+    return cache
+
+
+def fill_cache_entry(cache, file_hash, size, last_used):
+    kd.LockCacheEntries(file_hash)
+    kd.TouchCacheEntry(str(cache / file_hash))
+    (cache / file_hash / 'layer.png').write_bytes(b'x'*size)
+    kd.UnlockCacheEntries()
+    kd.CacheDB().execute('UPDATE entries SET last_used=? WHERE hash=?', (last_used, file_hash))
+
+
+def test_cache_gc_1(tmp_path, monkeypatch):
+    """ The least recently used entries are removed, using the sizes stored in the index """
+    cache = use_cache(tmp_path, monkeypatch, '--cache_max_size', '0.001')
+    for n, file_hash in enumerate(('aa', 'bb', 'cc', 'dd')):
+        fill_cache_entry(cache, file_hash, 400, 1000+n)
+    sizes = dict(kd.CacheDB().execute('SELECT hash, size FROM entries'))
+    # The .complete marker and the lock are empty
+    assert sizes == {'aa': 400, 'bb': 400, 'cc': 400, 'dd': 400}
+    # Using the entry again keeps its size
+    kd.TouchCacheEntry(str(cache / 'bb'))
+    assert kd.CacheDB().execute('SELECT size FROM entries WHERE hash=?', ('bb',)).fetchone()[0] == 400
+    # Only the entries not in the index are measured
+    (cache / 'ee').mkdir()
+    (cache / 'ee' / 'layer.png').write_bytes(b'x'*100)
+    measured = []
+    size = kd.CacheEntrySize
+    monkeypatch.setattr(kd, 'CacheEntrySize', lambda hash_dir: measured.append(hash_dir) or size(hash_dir))
+    # 1700 bytes, over the limit until `aa` and `dd` are removed, `cc` is protected and `bb` was just used
+    kd.CacheGC(['cc'])
+    assert measured == [str(cache / 'ee')]
+    assert sorted(os.listdir(str(cache))) == ['bb', 'cc', 'ee', kd.CACHE_DB]
+    assert sorted(h for h, in kd.CacheDB().execute('SELECT hash FROM entries')) == ['bb', 'cc']
+
+
+def test_cache_locks_1(tmp_path, monkeypatch):
+    """ Complete entries are shared, exclusive access is used only to create files """
+    cache = use_cache(tmp_path, monkeypatch)
+    hash_dir = str(cache / 'aa')
+    # A new entry is created, exclusive
+    kd.LockCacheEntries('aa')
+    assert kd.cache_locks[hash_dir][1]
+    assert kd.TryLockCacheEntry(hash_dir, False, shared=True) is None
+    kd.UnlockCacheEntries()
+    assert os.path.isfile(hash_dir+'/.complete')
+    # Now other runs can read it at the same time, but the GC can't remove it
+    other = kd.TryLockCacheEntry(hash_dir, False, shared=True)
+    kd.LockCacheEntries('aa')
+    assert not kd.cache_locks[hash_dir][1]
+    assert kd.TryLockCacheEntry(hash_dir, False) is None
+    # Creating a file must wait for the other run
+    threading.Timer(0.2, other.close).start()
+    start = time.time()
+    kd.WriteLockCacheEntry(hash_dir+'/0.pdf')
+    assert time.time()-start > 0.1
+    assert kd.cache_locks[hash_dir][1]
+    assert not os.path.isfile(hash_dir+'/.complete')
+    assert kd.TryLockCacheEntry(hash_dir, False, shared=True) is None
+    kd.UnlockCacheEntries()
+    assert os.path.isfile(hash_dir+'/.complete')
+    # An interrupted writer, its leftovers are removed, but not the files from running processes
+    os.remove(hash_dir+'/.complete')
+    dead = hash_dir+'/.tmp999999999_1_0.pdf'
+    alive = hash_dir+'/.tmp{}_1_0.pdf'.format(os.getpid())
+    for f in (dead, alive):
+        open(f, 'w').close()
+    kd.LockCacheEntries('aa')
+    assert kd.cache_locks[hash_dir][1]
+    assert not os.path.isfile(dead)
+    assert os.path.isfile(alive)
+    kd.UnlockCacheEntries()
+
+
+def test_cache_index_1(tmp_path, monkeypatch):
+    """ The metadata of the cached files is stored in the index, keyed by entry, layer, flavor and resolution """
+    cache = use_cache(tmp_path, monkeypatch)
+    hash_dir = str(cache / 'aa')
+    base_name = hash_dir+'/0'
+    assert kd.GetOptions(base_name+'.pdf') is None
+    assert not kd.CheckOptions(base_name+'.pdf', {'KiCad': '8.0'})
+    kd.WriteOptions(base_name+'.pdf', {'KiCad': '8.0', 'zones': 'none'})
+    assert kd.CheckOptions(base_name+'.pdf', {'zones': 'none', 'KiCad': '8.0'})
+    assert not kd.CheckOptions(base_name+'.pdf', {'KiCad': '8.0', 'zones': 'fill'})
+    assert not kd.CheckOptions(hash_dir+'/1.pdf', {'KiCad': '8.0', 'zones': 'none'})
+    kd.CacheSetValue(hash_dir, 'bbox', (1.5, 2, 3, 4))
+    assert kd.CacheGetValue(hash_dir, 'bbox') == [1.5, 2, 3, 4]
+    # The PNGs are valid only for the same plot, flavor and resolution
+    ops = kd.GetOptions(base_name+'.pdf')
+    os.makedirs(hash_dir)
+    png = kd.png_name(base_name)
+    open(png, 'w').close()
+    monkeypatch.setattr(kd, 'RASTERIZER', 'pdftoppm')
+    kd.SetPNGs(base_name, ops, [png])
+    assert kd.GetPNGs(base_name, base_name+'.pdf') == [png]
+    kd.resolution = 300
+    assert kd.GetPNGs(base_name, base_name+'.pdf') is None
+    kd.resolution = 150
+    monkeypatch.setattr(kd, 'RASTERIZER', 'gs')
+    assert kd.GetPNGs(base_name, base_name+'.pdf') is None
+    monkeypatch.setattr(kd, 'RASTERIZER', 'pdftoppm')
+    kd.WriteOptions(base_name+'.pdf', {'KiCad': '9.0', 'zones': 'none'})
+    assert kd.GetPNGs(base_name, base_name+'.pdf') is None
+    # Stored in the cache dir, so other runs see it
+    monkeypatch.setattr(kd, 'cache_dbs', {})
+    assert kd.CacheGetValue(hash_dir, 'bbox') == [1.5, 2, 3, 4]
+    kd.CacheRemoveEntry('aa')
+    assert kd.CacheGetValue(hash_dir, 'bbox') is None
+    assert kd.GetOptions(base_name+'.pdf') is None
+    # Each cache has its own index
+    other = tmp_path / 'other'
+    other.mkdir()
+    kd.CacheSetValue(hash_dir, 'bbox', (1, 2, 3, 4))
+    monkeypatch.setattr(kd, 'cache_dir', str(other))
+    assert kd.CacheGetValue(str(other / 'aa'), 'bbox') is None
+
+
+class FakeCairoSVG(object):
+    """ Renders a gray square, counting the conversions """
+    def __init__(self):
+        self.converted = 0
+
+    def svg2png(self, url, write_to, dpi, background_color):
+        self.converted += 1
+        Image.fromarray(np.full((20, 30), 100, dtype=np.uint8)).save(write_to, 'PNG')
+
+
+@needs_numpy
+def test_svg_flavor_1(tmp_path, monkeypatch):
+    """ The PNGs from SVGs are converted again when the converter, the color mode or the resolution changes """
+    cache = use_cache(tmp_path, monkeypatch)
+    hash_dir = str(cache / 'aa')
+    os.makedirs(hash_dir)
+    for sheet in ('', '-sub'):
+        open(hash_dir+'/sch'+sheet+'.svg', 'w').close()
+    cairosvg = FakeCairoSVG()
+    monkeypatch.setattr(kd, 'cairosvg', cairosvg, raising=False)
+    monkeypatch.setattr(kd, 'has_cairosvg', True)
+    monkeypatch.setattr(kd, 'cur_sch_ops', {'KiCad': '8.0'})
+    monkeypatch.setattr(kd, 'cache_locks', {})
+    # Already plotted
+    kd.WriteOptions(hash_dir+'/options', kd.cur_sch_ops)
+
+    def gen():
+        layers = {0: 'Schematic_all'}
+        kd.GenSCHImageSVG('sch.kicad_sch', 'aa', hash_dir, 'sch', layers, False)
+        return layers
+
+    assert sorted(gen()) == [kd.SCHEMATIC_SVG_BASE_NAME, kd.SCHEMATIC_SVG_BASE_NAME+'-sub']
+    assert cairosvg.converted == 2
+    gen()
+    assert cairosvg.converted == 2
+    kd.resolution = 300
+    gen()
+    assert cairosvg.converted == 4
+    # Black and white
+    setup_args('--cache_dir', str(cache), '--mono')
+    gen()
+    assert cairosvg.converted == 6
+    png = hash_dir+'/'+kd.SCHEMATIC_SVG_BASE_NAME+'.png'
+    with Image.open(png) as img:
+        assert img.mode == '1'
+        assert img.getpixel((0, 0)) == 0
+    # Using rsvg-convert
+    monkeypatch.setattr(kd, 'has_cairosvg', False)
+    converted = []
+    monkeypatch.setattr(kd, 'run_command', lambda cmd: converted.append(cmd[-1]) or shutil.copy(png, cmd[-2]))
+    gen()
+    assert sorted(converted) == [hash_dir+'/sch-sub.svg', hash_dir+'/sch.svg']
+    assert cairosvg.converted == 6
+
+
+def test_layer_digests_1():
+    """ Only F.Cu changed between the two versions of case 1 """
+    old = kd.layer_digests(os.path.join(CASES, '1', 'a', '1.kicad_pcb'))
+    new = kd.layer_digests(os.path.join(CASES, '1', 'b', '1.kicad_pcb'))
+    assert old.keys() == new.keys()
+    assert [la for la in old if old[la] != new[la]] == ['F.Cu']
+
+
+def test_normalized_hash_1(tmp_path):
+    """ UUIDs, time stamps, properties order and white spaces doesn't affect the hash """
+    sch = ('(kicad_sch (version 20231120) (generator "eeschema") (uuid "{}")\n'
+           '  (symbol (lib_id "Device:R") (at 10 10 0) (uuid "{}")\n'
+           '    {}\n    {}))\n')
+    ref = '(property "Reference" "R1" (at 1 1 0))'
+    val = '(property "Value" "{}" (at 2 2 0))'
+    files = {'a': sch.format('1', '2', ref, val.format('10k')),
+             'b': sch.format('3', '4', val.format('10k'), ref).replace('\n    ', ' '),
+             'c': sch.format('1', '2', ref, val.format('22k'))}
+    digests = {}
+    for name, text in files.items():
+        file = tmp_path / (name+'.kicad_sch')
+        file.write_text(text)
+        digests[name] = kd.NormalizedDigest(str(file))
+    assert digests['a'] == digests['b']
+    assert digests['a'] != digests['c']
+    # A real PCB, using new UUIDs
+    pcb = os.path.join(CASES, '1', 'a', '1.kicad_pcb')
+    with open(pcb, 'rt') as f:
+        text = f.read()
+    count = [0]
+
+    def new_uuid(m):
+        count[0] += 1
+        return '(uuid "{:08d}-0000-0000-0000-000000000000")'.format(count[0])
+
+    file = tmp_path / 'uuids.kicad_pcb'
+    file.write_text(re.sub(r'\(uuid "[^"]*"\)', new_uuid, text))
+    assert count[0] > 0
+    assert kd.NormalizedDigest(str(file)) == kd.NormalizedDigest(pcb)
+    assert kd.GetDigest(str(file)) != kd.GetDigest(pcb)
+
+
+def test_file_digest_1(tmp_path, monkeypatch):
+    """ The digests are memoized, computed again when the size, mtime or inode changes """
+    use_cache(tmp_path, monkeypatch)
+    monkeypatch.setattr(kd, 'DIGEST_BUFFER', 7)
+    data = bytes(range(100))
+    file = tmp_path / 'a.kicad_pcb'
+    file.write_bytes(data)
+    assert kd.GetDigest(str(file)) == hashlib.sha1(data).hexdigest()
+    hashed = []
+    digest = kd.GetDigest
+    monkeypatch.setattr(kd, 'GetDigest', lambda name: hashed.append(name) or digest(name))
+    # Recently modified, not memoized
+    assert kd.FileDigest(str(file)) == hashlib.sha1(data).hexdigest()
+    kd.FileDigest(str(file))
+    assert len(hashed) == 2
+    old = time.time()-60
+    os.utime(str(file), (old, old))
+    kd.FileDigest(str(file))
+    assert kd.FileDigest(str(file)) == hashlib.sha1(data).hexdigest()
+    assert len(hashed) == 3
+    # Modified
+    os.utime(str(file), (old-60, old-60))
+    kd.FileDigest(str(file))
+    assert len(hashed) == 4
+    # Replaced by another file
+    new = tmp_path / 'b.kicad_pcb'
+    new.write_bytes(data[::-1])
+    os.utime(str(new), (old-60, old-60))
+    os.replace(str(new), str(file))
+    assert kd.FileDigest(str(file)) == hashlib.sha1(data[::-1]).hexdigest()
+    assert len(hashed) == 5
+    # The normalized digests are memoized separately
+    setup_args('--cache_dir', kd.cache_dir, '--normalized_hash')
+    monkeypatch.setattr(kd, 'NormalizedDigest', lambda name: 'normalized')
+    assert kd.FileDigest(str(file)) == 'normalized'
+    setup_args('--cache_dir', kd.cache_dir)
+    assert kd.FileDigest(str(file)) == hashlib.sha1(data[::-1]).hexdigest()
+    assert len(hashed) == 5
+
+
+def git(repo, *cmd):
+    return subprocess.check_output(['git', '-C', str(repo)]+list(cmd)).decode().strip()
+
+
+def test_git_blob_hash_1(tmp_path, monkeypatch):
+    """ The hash for an uncommitted file is the hash git uses after committing it, even when git filters it """
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    git(repo, 'init', '-q')
+    (repo / '.gitattributes').write_text('*.kicad_pcb text eol=lf\n')
+    pcb = repo / 'a.kicad_pcb'
+    pcb.write_bytes(b'(kicad_pcb\r\n  (version 20240108)\r\n)\r\n')
+    monkeypatch.chdir(str(repo))
+    blob_hash = kgd.git_blob_hash(str(pcb), 'a.kicad_pcb')
+    git(repo, 'add', '.')
+    git(repo, '-c', 'user.name=KiDiff', '-c', 'user.email=kidiff@example.com', 'commit', '-q', '-m', 'PCB')
+    assert blob_hash == git(repo, 'rev-parse', 'HEAD:a.kicad_pcb')
+    # Without git we compute it, but we can't apply the filters
+
+    def no_git(cmd):
+        raise OSError()
+
+    monkeypatch.setattr(kgd, 'check_output', no_git)
+    (repo / 'b.kicad_pcb').write_bytes(b'(kicad_pcb)\n')
+    assert kgd.git_blob_hash(str(repo / 'b.kicad_pcb'), 'b.kicad_pcb') == git(repo, 'hash-object', 'b.kicad_pcb')
+
+
+def fake_diff():
+    """ run_diff replacement for the daemon tests """
+    if kd.args.new_file.endswith('bad'):
+        raise ValueError('Bad file')
+    os.write(1, 'Comparing {} and {} at {}\n'.format(kd.args.old_file, kd.args.new_file, os.getcwd()).encode())
+    if kd.args.new_file.endswith('same'):
+        exit(kd.NOTHING_TO_COMPARE)
+    return None
+
+
+def start_daemon(tmp_path, monkeypatch):
+    """ Start a daemon, the jobs use fake_diff """
+    sock = str(tmp_path / 'daemon.sock')
+    setup_args('--daemon', sock)
+    for name in ('check_tools', 'load_pcbnew', 'configure'):
+        monkeypatch.setattr(kd, name, lambda: None)
+    monkeypatch.setattr(kd, 'run_diff', fake_diff)
+
+    def daemon(parser):
+        # Like a real process, the messages go to the file descriptors
+        kd.stdout = sys.stdout = open(1, 'w', closefd=False)
+        kd.stderr = sys.stderr = open(2, 'w', closefd=False)
+        logging.getLogger().handlers = []
+        kd.Daemon(parser)
+
+    p = multiprocessing.get_context('fork').Process(target=daemon, args=(kd.create_parser(),))
+    p.start()
+    for _ in range(100):
+        if os.path.exists(sock):
+            break
+        time.sleep(0.05)
+    return p, sock
+
+
+def test_daemon_1(tmp_path, monkeypatch, capfd):
+    """ The daemon runs the jobs using our stdout/stderr and working dir, we get the exit code """
+    p, sock = start_daemon(tmp_path, monkeypatch)
+    monkeypatch.chdir(str(tmp_path))
+    try:
+        assert kgd.run_daemon(['kicad-diff.py', 'a.kicad_pcb', 'b.kicad_pcb'], sock) == 0
+        assert capfd.readouterr().out == 'Comparing a.kicad_pcb and b.kicad_pcb at {}\n'.format(tmp_path)
+        assert kgd.run_daemon(['kicad-diff.py', 'a.kicad_pcb', 'same'], sock) == kd.NOTHING_TO_COMPARE
+        assert kgd.run_daemon(['kicad-diff.py', 'a.kicad_pcb', 'bad'], sock) == kd.INTERNAL_ERROR
+        err = capfd.readouterr().err
+        assert 'Traceback' in err
+        assert 'ValueError: Bad file' in err
+        # Wrong command line
+        assert kgd.run_daemon(['kicad-diff.py', 'a.kicad_pcb'], sock) == kd.ARGS_ERROR
+        assert 'required: old_file, new_file' in capfd.readouterr().err
+    finally:
+        p.terminate()
+        p.join()
+    # No daemon
+    assert kgd.run_daemon(['kicad-diff.py', 'a.kicad_pcb', 'b.kicad_pcb'], sock) is None
+
+
+def test_daemon_peer_uid_1(tmp_path, monkeypatch, capfd):
+    """ The daemon only runs jobs for its user, and the clients only use daemons from its user """
+    # Connections from another user are rejected
+    monkeypatch.setattr(kd, 'getuid', lambda: os.getuid()+1)
+    p, sock = start_daemon(tmp_path, monkeypatch)
+    try:
+        assert kgd.run_daemon(['kicad-diff.py', 'a.kicad_pcb', 'b.kicad_pcb'], sock) == kgd.INTERNAL_ERROR
+        assert 'Comparing' not in capfd.readouterr().out
+        # A daemon from another user is ignored
+        monkeypatch.setattr(kgd, 'getuid', lambda: os.getuid()+1)
+        assert kgd.run_daemon(['kicad-diff.py', 'a.kicad_pcb', 'b.kicad_pcb'], sock) is None
+    finally:
+        p.terminate()
+        p.join()
+
+
+class FakePcbnew(object):
+    @staticmethod
+    def GetBuildVersion():
+        return '8.0.1'
+
+
+def make_tool(bin_dir, name):
+    tool = bin_dir / name
+    tool.write_text('#!/bin/sh\n')
+    tool.chmod(0o755)
+    return str(tool)
+
+
+def test_tools_cache_1(tmp_path, monkeypatch):
+    """ The tools detected by a run are used by the next runs, until something changes """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    pdftoppm = make_tool(bin_dir, 'pdftoppm')
+    monkeypatch.setenv('PATH', str(bin_dir))
+    monkeypatch.setattr(kd, 'TOOLS_CACHE', str(tmp_path / 'kidiff' / 'tools.json'))
+    monkeypatch.setattr(kd, 'tools', {})
+    monkeypatch.setattr(kd, 'FONT', '')
+    monkeypatch.setattr(kd, 'kicad_version', None, raising=False)
+    monkeypatch.setattr(kd, 'kicad_version_major', 0)
+    monkeypatch.setattr(kd, 'pcbnew', FakePcbnew)
+    probed = []
+
+    def check_image_magick():
+        probed.append(True)
+        kd.FONT = 'Helvetica'
+
+    monkeypatch.setattr(kd, 'check_image_magick', check_image_magick)
+    setup_args()
+
+    def check():
+        kd.tools.clear()
+        kd.FONT = ''
+        kd.kicad_version = None
+        kd.check_tools()
+        assert kd.find_tool('pdftoppm') == pdftoppm
+        assert kd.FONT == 'Helvetica'
+        assert kd.kicad_version_major == 8
+        return len(probed)
+
+    assert check() == 1
+    assert os.path.isfile(kd.TOOLS_CACHE)
+    assert check() == 1
+    # A tool was updated
+    os.utime(pdftoppm, (1, 1))
+    assert check() == 2
+    assert check() == 2
+    # A tool was added to the PATH
+    gs = make_tool(bin_dir, 'gs')
+    os.utime(str(bin_dir), (2, 2))
+    assert check() == 3
+    assert kd.find_tool('gs') == gs
+    # A different PATH
+    monkeypatch.setenv('PATH', str(bin_dir)+os.pathsep+str(tmp_path))
+    assert check() == 4
+    assert check() == 4
+    # Not using the cache
+    setup_args('--no_tools_cache')
+    assert check() == 5
+    # A broken cache
+    setup_args()
+    with open(kd.TOOLS_CACHE, 'wt') as f:
+        f.write('{')
+    assert check() == 6
+    assert check() == 6
+
+
+def test_kicad_version_1(tmp_path, monkeypatch):
+    """ The KiCad version comes from kicad-cli, the KiCad module is loaded only for old versions """
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    monkeypatch.setenv('PATH', str(bin_dir))
+    monkeypatch.setattr(kd, 'tools', {})
+    monkeypatch.setattr(kd, 'FONT', 'Helvetica')
+    monkeypatch.setattr(kd, 'kicad_version', None, raising=False)
+    monkeypatch.setattr(kd, 'kicad_version_major', 0)
+    monkeypatch.setattr(kd, 'check_image_magick', lambda: None)
+    loaded = []
+    monkeypatch.setattr(kd, 'load_pcbnew', lambda: loaded.append(True))
+    monkeypatch.setattr(kd, 'pcbnew', FakePcbnew)
+    monkeypatch.setattr(FakePcbnew, 'GetBuildVersion', staticmethod(lambda: '(6.0.11-2.fc36)'))
+    setup_args('--no_tools_cache')
+    # KiCad 5 and 6
+    kd.check_tools()
+    assert loaded
+    assert kd.kicad_version == '6.0.11'
+    assert kd.kicad_version_major == 6
+    # kicad-cli
+    (bin_dir / 'kicad-cli').write_text('#!/bin/sh\necho 8.0.2\n')
+    (bin_dir / 'kicad-cli').chmod(0o755)
+    loaded.clear()
+    kd.check_tools()
+    assert not loaded
+    assert kd.kicad_version == '8.0.2'
+    assert kd.kicad_version_major == 8
+
+
+def test_load_batch_1(tmp_path):
+    """ The --batch file can be a CSV with a header or a JSON list """
+    setup_args()
+    csv_file = tmp_path / 'diffs.csv'
+    csv_file.write_text('old_file,new_file,new_file_hash,name\na.kicad_pcb,b.kicad_pcb,,First\n'
+                        'c.kicad_sch,d.kicad_sch,1234,Second\n')
+    json_file = tmp_path / 'diffs.json'
+    json_file.write_text('[{"old_file": "a.kicad_pcb", "new_file": "b.kicad_pcb", "name": "First"},'
+                         ' {"old_file": "c.kicad_sch", "new_file": "d.kicad_sch", "new_file_hash": "1234",'
+                         '  "name": "Second"}]')
+    diffs = kd.load_batch(str(csv_file))
+    assert [(d['old_file'], d['new_file'], d['new_file_hash'], d['name']) for d in diffs] == \
+        [('a.kicad_pcb', 'b.kicad_pcb', '', 'First'), ('c.kicad_sch', 'd.kicad_sch', '1234', 'Second')]
+    assert [{k: v for k, v in d.items() if v} for d in diffs] == kd.load_batch(str(json_file))
+    # Wrong files
+    for name, text, code in (('missing.csv', 'old_file,new_file\na.kicad_pcb,\n', kd.WRONG_ARGUMENT),
+                             ('unknown.csv', 'old_file,new_file,zones\na.kicad_pcb,b.kicad_pcb,fill\n',
+                              kd.WRONG_ARGUMENT),
+                             ('dict.json', '{"old_file": "a.kicad_pcb", "new_file": "b.kicad_pcb"}', kd.WRONG_ARGUMENT),
+                             ('broken.json', '[{"old_file": ', kd.WRONG_ARGUMENT),
+                             ('empty.csv', 'old_file,new_file\n', kd.NOTHING_TO_COMPARE)):
+        (tmp_path / name).write_text(text)
+        with pytest.raises(SystemExit) as e:
+            kd.load_batch(str(tmp_path / name))
+        assert e.value.code == code, name
+    with pytest.raises(SystemExit) as e:
+        kd.load_batch(str(tmp_path / 'none.csv'))
+    assert e.value.code == kd.WRONG_ARGUMENT
+
+
+def test_range_batch_1(tmp_path, monkeypatch):
+    """ --range creates a --batch file for the PCBs and SCHs modified in a range of commits """
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    git(repo, 'init', '-q')
+    monkeypatch.chdir(str(repo))
+
+    def commit(files):
+        for name, text in files.items():
+            (repo / name).write_text(text)
+        git(repo, 'add', '.')
+        git(repo, '-c', 'user.name=KiDiff', '-c', 'user.email=kidiff@example.com', 'commit', '-q', '-m', 'Change')
+
+    commit({'a.kicad_pcb': '(kicad_pcb 1)\n', 'b.kicad_sch': '(kicad_sch 1)\n', 'c.txt': '1\n'})
+    commit({'a.kicad_pcb': '(kicad_pcb 2)\n', 'b.kicad_sch': '(kicad_sch 2)\n', 'c.txt': '2\n',
+            'd.kicad_pcb': '(kicad_pcb 1)\n'})
+    monkeypatch.setattr(kgd, 'args', argparse.Namespace(normalized_hash=False), raising=False)
+    setup_args()
+    tmp_dir = tmp_path / 'tmp'
+    tmp_dir.mkdir()
+    diffs = kd.load_batch(kgd.range_batch('HEAD~1..HEAD', str(tmp_dir)))
+    # Only the modified PCBs and SCHs
+    assert [d['name'] for d in diffs] == ['a.kicad_pcb', 'b.kicad_sch']
+    for d in diffs:
+        for side, rev in (('old', 'HEAD~1'), ('new', 'HEAD')):
+            with open(d[side+'_file']) as f:
+                assert f.read() == git(repo, 'show', rev+':'+d['name'])+'\n'
+            assert d[side+'_file_hash'] == git(repo, 'rev-parse', rev+':'+d['name'])
+    # Against the working tree
+    (repo / 'b.kicad_sch').write_text('(kicad_sch 3)\n')
+    diffs = kd.load_batch(kgd.range_batch('HEAD', str(tmp_dir)))
+    assert len(diffs) == 1
+    assert diffs[0]['new_file'] == 'b.kicad_sch'
+    assert diffs[0]['old_file_hash'] == git(repo, 'rev-parse', 'HEAD:b.kicad_sch')
+    assert diffs[0]['new_file_hash'] == git(repo, 'hash-object', 'b.kicad_sch')
+    # The normalized hash is computed by kicad-diff.py
+    kgd.args.normalized_hash = True
+    diffs = kd.load_batch(kgd.range_batch('HEAD', str(tmp_dir)))
+    assert 'old_file_hash' not in diffs[0]
+
+
+@needs_numpy
+def test_np_palette_1():
+    """ Diffs with few colors are stored using a palette, without losing colors """
+    rng = np.random.default_rng(3)
+    for colors, bits in ((2, 1), (4, 2), (16, 4), (200, 8)):
+        lut = rng.integers(0, 256, (colors, 3), dtype=np.uint8)
+        img = Image.fromarray(lut[rng.integers(0, colors, (300, 40))])
+        pal, pal_bits = kd.np_palette(img)
+        assert pal_bits == bits
+        assert np.array_equal(np.asarray(pal.convert('RGB')), np.asarray(img))
+    img = Image.fromarray(rng.integers(0, 256, (30, 40, 3), dtype=np.uint8))
+    assert kd.np_palette(img) is None
+    # No full size 32 bits copies of the page: the RGB array, the indexes (and the copy passed to Pillow) plus the
+    # buffers for a band
+    h, w = 2000, 1000
+    lut = np.array([[255, 255, 255], [255, 0, 0], [0, 0, 255]], dtype=np.uint8)
+    img = Image.fromarray(lut[rng.integers(0, 3, (h, w))])
+    tracemalloc.start()
+    try:
+        pal, _ = kd.np_palette(img)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < h*w*(3+1+1) + kd.PALETTE_BAND*w*(4+8) + 1024*1024
+
+
+@needs_numpy
+def test_mono_packed_1():
+    """ The mono diffs computed using the packed bits, compared to the unpacked computation """
+    setup_args('--mono')
+    rng = np.random.default_rng(2)
+    old = rng.integers(0, 256, (20, 37), dtype=np.uint8)
+    new = rng.integers(0, 256, (20, 37), dtype=np.uint8)
+    old_p, w = kd.np_pack(old)
+    new_p, _ = kd.np_pack(new)
+    for bits in (2, 4, 8):
+        rows, changes = kd.np_mono(old_p, new_p, w, bits)
+        img = Image.frombytes('P', (w, rows.shape[0]), np.ascontiguousarray(rows).tobytes(), 'raw',
+                              'P;{}'.format(bits) if bits < 8 else 'P')
+        assert np.array_equal(np.asarray(img), (new < 128)*2+(old < 128))
+        assert changes == 1
+    assert kd.np_mono(old_p, old_p, w, 2)[1] == 0
+
+
+@needs_numpy
+def test_raw_1(tmp_path):
+    """ Raw rasters are read back as written, broken files are reported """
+    setup_args()
+    rng = np.random.default_rng(4)
+    gray = rng.integers(0, 256, (20, 37), dtype=np.uint8)
+    packed, w = kd.np_pack(gray)
+    for data, width, bits in ((gray, 37, 8), (packed, w, 1)):
+        name = str(tmp_path / 'page{}.raw'.format(bits))
+        kd.write_raw(name, data, width, bits)
+        assert os.path.getsize(name) == struct.calcsize(kd.RAW_HEADER)+data.size
+        loaded, loaded_w, loaded_bits = kd.np_load_raw(name)
+        assert (loaded_w, loaded_bits) == (width, bits)
+        assert np.array_equal(loaded, data)
+        del loaded
+    # Wrong magic, short header and truncated data
+    with open(name, 'rb') as f:
+        raw = f.read()
+    for broken in (b'KIDIFFR0'+raw[8:], raw[:20], raw[:-1]):
+        (tmp_path / 'broken.raw').write_bytes(broken)
+        with pytest.raises(SystemExit) as e:
+            kd.np_load_raw(str(tmp_path / 'broken.raw'))
+        assert e.value.code == kd.FAILED_TO_CONVERT
+
+
+def write_raws(tmp_path, mono):
+    """ Two pages with some differences, and different sizes """
+    old = np.full((300, 250), 255, dtype=np.uint8)
+    old[20:80, 30:200] = 0
+    old[150:160, :] = 90
+    new = np.full((310, 245), 255, dtype=np.uint8)
+    new[20:80, 30:180] = 0
+    new[200:290, 100:120] = 0
+    raws = []
+    for name, img in (('old', old), ('new', new)):
+        raw = str(tmp_path / (name+'.raw'))
+        if mono:
+            kd.write_raw(raw, *kd.np_pack(img), 1)
+        else:
+            kd.write_raw(raw, img, img.shape[1], 8)
+        raws.append(raw)
+    return raws
+
+
+@needs_numpy
+@pytest.mark.parametrize('mono', (False, True))
+@pytest.mark.parametrize('mode', ('red_green', '2color', 'stats'))
+def test_banded_1(tmp_path, mode, mono):
+    """ The diffs computed in bands are the same we get for the whole page """
+    ops = ['--diff_mode', mode]
+    if mono:
+        ops.append('--mono')
+    setup_args(*ops)
+    old, new = write_raws(tmp_path, mono)
+    if mono:
+        create_diff = kd.create_diff_mono
+    else:
+        create_diff = {'red_green': kd.create_diff_stereo_np, '2color': kd.create_diff_stereo_colored_np,
+                       'stats': kd.create_diff_stat_np}[mode]
+    whole = str(tmp_path / 'whole.png')
+    assert create_diff(old, new, whole, '12', 'F.Cu', 150, 'Layer: F.Cu', True)
+    setup_args('--band_height', '16', *ops)
+    banded = str(tmp_path / 'banded.png')
+    assert kd.create_diff_banded(old, new, banded, '12', 'F.Cu', 150, 'Layer: F.Cu', True)
+    with Image.open(whole) as a, Image.open(banded) as b:
+        assert a.size == b.size == (250, 310)
+        assert np.array_equal(np.asarray(a.convert('RGB')), np.asarray(b.convert('RGB')))
+    # No changes
+    assert not kd.create_diff_banded(old, old, banded, '12', 'F.Cu', 150, 'Layer: F.Cu', True)
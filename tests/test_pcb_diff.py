@@ -44,3 +44,21 @@ def test_pcb_diff_layers_2(test_dir):
     ctx.run(layers=True)
     ctx.compare_out_pngs()
     ctx.clean_up()
+
+
+def test_pcb_jobs_1(test_dir):
+    """ Same as simple_1, but computing the layers in parallel """
+    ctx = context.TestContext(test_dir, 1)
+    ctx.run(ops=['--only_different', '--jobs', '4'])
+    ctx.compare_out_pngs()
+    ctx.clean_up()
+
+
+def test_pcb_skip_unchanged_1(test_dir):
+    """ Only F.Cu changed, the rest of the layers aren't plotted """
+    ctx = context.TestContext(test_dir, 1)
+    ctx.run(ops=['--only_different', '--skip_unchanged'])
+    assert ctx.search_err(r'Layer B.Cu is unchanged')
+    assert not ctx.search_err(r'Plotting B.Cu layer')
+    ctx.compare_image('diff-00.png')
+    ctx.clean_up()